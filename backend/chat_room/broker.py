@@ -0,0 +1,180 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+from typing import Callable, List, Optional, Set
+
+# 消息代理: memory 只在本进程内分发, unix 通过本地 Unix socket 在多个 worker 之间转发
+BROKER = os.getenv("CHAT_BROKER", "memory")
+BROKER_SOCKET = os.getenv("CHAT_BROKER_SOCKET", "/tmp/mcp_chat_broker.sock")
+RECONNECT_INTERVAL = 1.0
+# hub 给单个 worker 积压的字节数上限, 超过后断开该 worker
+HUB_MAX_BUFFER = 8 * 1024 * 1024
+
+Handler = Callable[[str, bytes], None]
+
+_HEADER = struct.Struct("!IH")
+
+
+def pack_record(topic: str, payload: bytes) -> bytes:
+    topic_bytes = topic.encode()
+    return _HEADER.pack(len(topic_bytes) + len(payload), len(topic_bytes)) + topic_bytes + payload
+
+
+async def read_record(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(_HEADER.size)
+    size, _ = _HEADER.unpack(header)
+    return header + await reader.readexactly(size)
+
+
+def unpack_record(record: bytes):
+    _, topic_len = _HEADER.unpack_from(record)
+    start = _HEADER.size
+    topic = record[start:start + topic_len].decode()
+    return topic, record[start + topic_len:]
+
+
+class Broker:
+    """Pub/sub transport under ChatRoomManager.
+
+    `publish` delivers to the local handlers synchronously and forwards to other
+    processes when the backend supports it; handlers receive (topic, payload).
+    """
+
+    def __init__(self):
+        self.handlers: List[Handler] = []
+
+    def subscribe(self, handler: Handler):
+        self.handlers.append(handler)
+
+    def deliver(self, topic: str, payload: bytes):
+        for handler in self.handlers:
+            try:
+                handler(topic, payload)
+            except Exception:
+                logging.exception(f"broker handler failed for topic {topic}")
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def publish(self, topic: str, payload: bytes):
+        self.deliver(topic, payload)
+
+
+class InMemoryBroker(Broker):
+    pass
+
+
+class UnixSocketBroker(Broker):
+    """Relays records between the uvicorn workers of one host.
+
+    Every worker connects to a hub listening on a Unix socket. The hub runs inside
+    whichever worker holds the flock on `<socket>.lock`; if that worker dies the lock
+    is released and the next worker to reconnect takes over.
+    """
+
+    def __init__(self, path: str = BROKER_SOCKET):
+        super().__init__()
+        self.path = path
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Set[asyncio.StreamWriter] = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+        if self._server:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def publish(self, topic: str, payload: bytes):
+        self.deliver(topic, payload)
+        writer = self._writer
+        if writer is None:
+            logging.warning(f"broker not connected, {topic} delivered locally only")
+            return
+        try:
+            writer.write(pack_record(topic, payload))
+            await writer.drain()
+        except ConnectionError:
+            logging.warning(f"broker connection lost while publishing {topic}")
+
+    async def _run(self):
+        while not self._closing:
+            await self._maybe_become_hub()
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            self._writer = writer
+            logging.info(f"connected to chat broker at {self.path}")
+            try:
+                while True:
+                    self.deliver(*unpack_record(await read_record(reader)))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logging.warning("chat broker connection closed, reconnecting")
+            finally:
+                self._writer = None
+                writer.close()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _maybe_become_hub(self):
+        if self._server is not None:
+            return
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.path)
+        logging.info(f"chat broker hub listening on {self.path}")
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        try:
+            while True:
+                record = await read_record(reader)
+                for peer in list(self._peers):
+                    if peer is writer:
+                        continue
+                    if peer.transport.get_write_buffer_size() > HUB_MAX_BUFFER:
+                        logging.warning("chat broker peer is too slow, dropping it")
+                        self._peers.discard(peer)
+                        peer.close()
+                        continue
+                    peer.write(record)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+
+def create_broker(kind: str = BROKER) -> Broker:
+    if kind == "memory":
+        return InMemoryBroker()
+    if kind == "unix":
+        return UnixSocketBroker()
+    raise ValueError(f"unknown chat broker: {kind}")
@@ -1,45 +1,390 @@
+import json
 import logging
-from typing import Dict, Set
+import os
+import uuid
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Set
 
 import asyncio
-from backend.db.chat_room import save_message
+from backend.chat_room.broker import Broker, create_broker
+from backend.db.chat_room import get_room_messages, save_message
+from backend.search.index import search_index
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# SSE connection manager
-from typing import Dict
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# 每个连接的队列上限，以及队列满时的处理策略
+QUEUE_MAXSIZE = int(os.getenv("CHAT_QUEUE_MAXSIZE", "256"))
+QUEUE_POLICY = os.getenv("CHAT_QUEUE_POLICY", "drop_oldest")
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_COALESCE = "coalesce"
+POLICY_DISCONNECT = "disconnect"
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# 每个房间在内存里保留最近的事件, 用于 SSE 断线重连 (Last-Event-ID) 时补发
+HISTORY_SIZE = int(os.getenv("CHAT_HISTORY_SIZE", "200"))
+HISTORY_ROOMS = int(os.getenv("CHAT_HISTORY_ROOMS", "1000"))
+
+# SSE 微批: 大于 0 时把时间窗口内排队的事件合并成一次写出, 空闲连接定期发送心跳注释
+SSE_BATCH_WINDOW = float(os.getenv("CHAT_SSE_BATCH_MS", "0")) / 1000
+SSE_HEARTBEAT = float(os.getenv("CHAT_SSE_HEARTBEAT_S", "15"))
+HEARTBEAT_FRAME = b": ping\r\n\r\n"
+
+
+def dumps(message: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class Frame:
+    """An event encoded once and shared by every subscriber of a room.
+
+    `payload` is the JSON body, `sse` the complete text/event-stream frame. Frames
+    with an `event_id` carry an SSE id line and are kept for Last-Event-ID replay.
+    """
+
+    __slots__ = ("payload", "sse", "event_id", "_text", "_msgpack")
+
+    def __init__(self, payload: bytes, event_id: Optional[str] = None):
+        self.payload = payload
+        self.event_id = event_id
+        id_line = b"id: " + event_id.encode() + b"\r\n" if event_id else b""
+        self.sse = id_line + b"event: message\r\ndata: " + payload + b"\r\n\r\n"
+        self._text = None
+        self._msgpack = None
+
+    @property
+    def text(self) -> str:
+        # WebSocket 文本帧, 第一次用到时解码并缓存
+        if self._text is None:
+            self._text = self.payload.decode()
+        return self._text
+
+    @property
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            self._msgpack = msgpack.packb(json.loads(self.payload))
+        return self._msgpack
+
+    @classmethod
+    def encode(cls, message: dict, event_id: Optional[str] = None) -> "Frame":
+        return cls(dumps(message), event_id)
+
+    def pack(self) -> bytes:
+        # JSON 里不会出现裸换行, 用它分隔事件 id 和 payload
+        return (self.event_id or "").encode() + b"\n" + self.payload
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "Frame":
+        event_id, payload = data.split(b"\n", 1)
+        return cls(payload, event_id.decode() or None)
+
+
+class SubscriberClosed(Exception):
+    pass
+
+
+class SubscriberQueue:
+    """Bounded queue for one SSE connection.
+
+    `offer` never blocks the broadcaster. When the queue is full the policy decides:
+    drop_oldest discards the oldest pending event, coalesce replaces the whole backlog
+    with a single overflow event (the client reloads history), and disconnect closes
+    the connection.
+    """
+
+    def __init__(self, user_id: str, room_id: str, maxsize: int = QUEUE_MAXSIZE, policy: str = QUEUE_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy: {policy}")
+        self.conn_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.room_id = room_id
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()
+        self._ready = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def offer(self, item: Frame) -> bool:
+        if self.closed:
+            return False
+        if self.maxsize > 0 and len(self._items) >= self.maxsize:
+            if self.policy == POLICY_DISCONNECT:
+                logging.warning(f"slow consumer {self.user_id} in room {self.room_id}, disconnecting")
+                self.dropped += len(self._items)
+                self.close()
+                return False
+            if self.policy == POLICY_COALESCE:
+                self.dropped += len(self._items)
+                self._items.clear()
+                self._items.append(self._overflow_event())
+            else:
+                self._items.popleft()
+                self.dropped += 1
+        self._items.append(item)
+        self._ready.set()
+        return True
+
+    def _overflow_event(self) -> Frame:
+        return Frame.encode({"type": "overflow", "data": {"room_id": self.room_id, "dropped": self.dropped}})
+
+    async def get(self) -> Frame:
+        await self.wait()
+        return self._items.popleft()
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until an event is queued; False if `timeout` passes first."""
+        while not self._items:
+            if self.closed:
+                raise SubscriberClosed()
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def drain(self) -> List[Frame]:
+        frames = list(self._items)
+        self._items.clear()
+        return frames
+
+    async def get_batch(self, window: float, timeout: Optional[float] = None) -> List[Frame]:
+        """Everything queued within `window` seconds of the first event; [] on timeout."""
+        if not await self.wait(timeout):
+            return []
+        if window > 0:
+            await asyncio.sleep(window)
+        return self.drain()
+
+    def close(self):
+        self.closed = True
+        self._items.clear()
+        self._ready.set()
+
+
+ROOM_TOPIC = "room:"
+
+
+def clean_mentions(mentions) -> List[dict]:
+    """Keep well-formed mention entries from client input: {"user_id": str, "username": str, "index": int}."""
+    cleaned = []
+    for mention in mentions if isinstance(mentions, list) else []:
+        if not isinstance(mention, dict) or not isinstance(mention.get("user_id"), str):
+            continue
+        entry = {"user_id": mention["user_id"]}
+        if isinstance(mention.get("username"), str):
+            entry["username"] = mention["username"]
+        index = mention.get("index")
+        if isinstance(index, int) and not isinstance(index, bool) and 0 <= index < 2 ** 31:
+            entry["index"] = index
+        cleaned.append(entry)
+    return cleaned
+
+
+def message_event(message: dict) -> dict:
+    """The broadcast event of a saved message."""
+    return {
+        "type": "message",
+        "data": {
+            "id": str(message["_id"]),
+            "content": message["content"],
+            "sender_id": message["sender_id"],
+            "sender_username": message["sender_username"],
+            "created_at": message["created_at"].isoformat(),
+            "mentions": message.get("mentions", []),
+            "room_id": message["room_id"],
+        },
+    }
 
 
 class ChatRoomManager:
-    def __init__(self):
-        self.active_connections: Dict[str, Dict[str, asyncio.Queue]] = {}
-        self.global_message_queue = asyncio.Queue()
-        self.enter_room_queue = asyncio.Queue() 
-    async def enter_room(self, user_id: str, room_id: str):
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = {}
-        if user_id not in self.active_connections[room_id]:
-            self.active_connections[room_id][user_id] = asyncio.Queue()
-        await self.enter_room_queue.put((user_id,room_id))
-        return self.active_connections[room_id][user_id]
-
-
-    def disconnect(self, user_id: str, room_id: str):
-        if room_id in self.active_connections:
-            if user_id in self.active_connections[room_id]:
-                del self.active_connections[room_id][user_id]
-                if not self.active_connections[room_id]:
-                    del self.active_connections[room_id]
-
-    async def broadcast(self, message: dict, room_id: str):
-        if room_id in self.active_connections:
-            for user_id in self.active_connections[room_id]:
-                await self.active_connections[room_id][user_id].put(message)
-        await self.global_message_queue.put(message)
+    def __init__(self, broker: Optional[Broker] = None):
+        self.active_connections: Dict[str, Dict[str, SubscriberQueue]] = {}
+        self.history: OrderedDict[str, deque] = OrderedDict()
+        # 已经从消息库补齐过的房间, 以及正在补齐的加载任务
+        self.seeded: Set[str] = set()
+        self._seeding: Dict[str, asyncio.Task] = {}
+        # agent 订阅索引: 被 @ 的用户 id / 房间 id -> 收件队列
+        self.mention_subscriptions: Dict[str, Set[asyncio.Queue]] = {}
+        self.room_subscriptions: Dict[str, Set[asyncio.Queue]] = {}
+        self.enter_room_queue = asyncio.Queue()
+        self.broker = broker or create_broker()
+        self.broker.subscribe(self._on_broker_message)
+
+    async def start(self):
+        await self.broker.start()
+
+    async def close(self):
+        await self.broker.close()
+
+    def _on_broker_message(self, topic: str, payload: bytes):
+        if topic.startswith(ROOM_TOPIC):
+            self.fanout(Frame.unpack(payload), topic[len(ROOM_TOPIC):])
+
+    async def enter_room(self, user_id: str, room_id: str, last_event_id: Optional[str] = None) -> SubscriberQueue:
+        queue = SubscriberQueue(user_id, room_id)
+        if last_event_id:
+            await self.seed_history(room_id)
+            self.replay(queue, room_id, last_event_id)
+        self.active_connections.setdefault(room_id, {})[queue.conn_id] = queue
+        await self.enter_room_queue.put((user_id, room_id))
+        return queue
+
+    def replay(self, queue: SubscriberQueue, room_id: str, last_event_id: str):
+        """Queue the events after `last_event_id`, or a resync event if it is no longer buffered."""
+        frames = list(self.history.get(room_id, ()))
+        for i in range(len(frames) - 1, -1, -1):
+            if frames[i].event_id == last_event_id:
+                for frame in frames[i + 1:]:
+                    queue.offer(frame)
+                return
+        queue.offer(Frame.encode({"type": "resync", "data": {"room_id": room_id}}))
+
+    async def seed_history(self, room_id: str):
+        """Fill the replay buffer of a room from the message store, once per process.
+
+        After a restart the buffer is empty and every reconnecting client would get a
+        resync; concurrent reconnects to the same room share one query.
+        """
+        if room_id in self.seeded:
+            return
+        task = self._seeding.get(room_id)
+        if task is None:
+            task = self._seeding[room_id] = asyncio.create_task(self._seed(room_id))
+            task.add_done_callback(lambda done: self._seeded(room_id, done))
+        try:
+            await asyncio.shield(task)
+        except Exception as e:
+            # 补齐失败时退回 resync, 客户端自己从 /room_messages 重新加载
+            logging.warning(f"failed to seed history of room {room_id}: {e!r}")
+
+    async def _seed(self, room_id: str):
+        messages = await get_room_messages(room_id, limit=HISTORY_SIZE)
+        frames = [Frame.encode(message_event(message), str(message["_id"])) for message in reversed(messages)]
+        # 加载期间广播的事件已经记在缓冲区里, 接在库里的消息后面
+        loaded = {frame.event_id for frame in frames}
+        history = self._history(room_id)
+        live = [frame for frame in history if frame.event_id not in loaded]
+        history.clear()
+        history.extend(frames)
+        history.extend(live)
+        self.seeded.add(room_id)
+
+    def _seeded(self, room_id: str, task: asyncio.Task):
+        if self._seeding.get(room_id) is task:
+            del self._seeding[room_id]
+        if not task.cancelled():
+            task.exception()
+
+    def _history(self, room_id: str) -> deque:
+        history = self.history.get(room_id)
+        if history is None:
+            history = self.history[room_id] = deque(maxlen=HISTORY_SIZE)
+            if len(self.history) > HISTORY_ROOMS:
+                evicted, _ = self.history.popitem(last=False)
+                self.seeded.discard(evicted)
+        else:
+            self.history.move_to_end(room_id)
+        return history
+
+    def remember(self, frame: Frame, room_id: str):
+        self._history(room_id).append(frame)
+
+    def disconnect(self, room_id: str, queue: SubscriberQueue):
+        queue.close()
+        room = self.active_connections.get(room_id)
+        if room is None:
+            return
+        room.pop(queue.conn_id, None)
+        if not room:
+            del self.active_connections[room_id]
+
+    def fanout(self, frame: Frame, room_id: str):
+        if frame.event_id:
+            self.remember(frame, room_id)
+        room = self.active_connections.get(room_id)
+        if not room:
+            return
+        for queue in list(room.values()):
+            if not queue.offer(frame) and queue.closed:
+                self.disconnect(room_id, queue)
+
+    def subscribe_mentions(self, user_id: str) -> asyncio.Queue:
+        inbox = asyncio.Queue()
+        self.mention_subscriptions.setdefault(user_id, set()).add(inbox)
+        return inbox
+
+    def subscribe_room_messages(self, room_id: str) -> asyncio.Queue:
+        inbox = asyncio.Queue()
+        self.room_subscriptions.setdefault(room_id, set()).add(inbox)
+        return inbox
+
+    def unsubscribe(self, inbox: asyncio.Queue):
+        for index in (self.mention_subscriptions, self.room_subscriptions):
+            for key in [key for key, inboxes in index.items() if inbox in inboxes]:
+                index[key].discard(inbox)
+                if not index[key]:
+                    del index[key]
+
+    def route(self, message: dict, room_id: str):
+        if message.get("type") != "message":
+            return
+        inboxes = set(self.room_subscriptions.get(room_id, ()))
+        for mention in message["data"].get("mentions") or []:
+            # mentions 来自客户端, 跳过格式不对的条目
+            user_id = mention.get("user_id") if isinstance(mention, dict) else None
+            if isinstance(user_id, str):
+                inboxes.update(self.mention_subscriptions.get(user_id, ()))
+        for inbox in inboxes:
+            inbox.put_nowait(message)
+
+    async def broadcast(self, message: dict, room_id: str, event_id: Optional[str] = None):
+        # 订阅者的分发由 broker 完成(包括其它 worker); agent 只处理本进程发出的消息, 避免多个 worker 重复回复
+        await self.broker.publish(ROOM_TOPIC + room_id, Frame.encode(message, event_id).pack())
+        self.route(message, room_id)
+
+    def room_stats(self, room_id: str) -> Optional[dict]:
+        room = self.active_connections.get(room_id)
+        if room is None:
+            return None
+        depths = [queue.qsize() for queue in room.values()]
+        return {
+            "room_id": room_id,
+            "connections": len(room),
+            "total_depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": sum(queue.dropped for queue in room.values()),
+            "subscribers": [
+                {
+                    "user_id": queue.user_id,
+                    "depth": queue.qsize(),
+                    "dropped": queue.dropped,
+                    "policy": queue.policy,
+                }
+                for queue in room.values()
+            ],
+        }
 
     async def send_message(
         self, content: str, user_id: str, user_name: str, room_id: str, mentions: list = None
     ):
         logging.info(f"send_message: {content} {user_id} {user_name} {room_id} {mentions}")
+        mentions = clean_mentions(mentions)
         saved_message = await save_message(
             content=content,
             sender_id=user_id,
@@ -47,21 +392,13 @@ class ChatRoomManager:
             room_id=room_id,
             mentions=mentions
         )
-        await self.broadcast(
-            {
-                "type": "message",
-                "data": {
-                    "id": str(saved_message["_id"]),
-                    "content": saved_message["content"],
-                    "sender_id": saved_message["sender_id"],
-                    "sender_username": saved_message["sender_username"],
-                    "created_at": saved_message["created_at"].isoformat(),
-                    "mentions": saved_message.get("mentions", []),
-                    "room_id": room_id,
-                },
-            },
-            room_id,
-        )
+        message_id = str(saved_message["_id"])
+        await self.broadcast(message_event(saved_message), room_id, message_id)
+        # 消息已保存并广播, 索引失败只影响搜索
+        try:
+            await search_index.add(saved_message)
+        except Exception:
+            logging.exception(f"failed to index message {message_id} of room {room_id}")
         return saved_message
 
 
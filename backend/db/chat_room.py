@@ -1,15 +1,360 @@
-from datetime import datetime
+import asyncio
+import copy
+from datetime import datetime, timedelta
 import logging
+import os
+import uuid
 
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError, WriteConcernError
 
+from backend.cache import AsyncCache
 from backend.db.conn import db
 from backend.db.user import get_user_by_id
 
 # 数据库集合
 messages_collection = db.messages
+message_buckets_collection = db.message_buckets
 chat_rooms_collection = db.chat_rooms
 
+# 消息存储方式: document 每条消息一个文档; bucket 按房间把消息分桶存放
+MESSAGE_STORAGE = os.getenv("CHAT_MESSAGE_STORAGE", "document")
+BUCKET_SIZE = int(os.getenv("CHAT_BUCKET_SIZE", "200"))
+BUCKET_SPAN = timedelta(seconds=int(os.getenv("CHAT_BUCKET_SPAN_S", "3600")))
+
+# write-behind: 消息先广播, 再按批量/时间窗口写入 MongoDB
+WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "200"))
+WRITE_BATCH_INTERVAL = float(os.getenv("CHAT_WRITE_BATCH_INTERVAL_MS", "50")) / 1000
+WRITE_RETRY_MAX_BACKOFF = 5.0
+WRITE_CLOSE_RETRIES = 5
+
+DUPLICATE_KEY = 11000
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed write may succeed if retried (network, failover, write concern)."""
+    if isinstance(error, (ConnectionFailure, WriteConcernError)):
+        return True
+    return isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError")
+
+# 历史消息按 (created_at, _id) 做 keyset 分页
+MESSAGE_FIELDS = ("content", "sender_id", "sender_username", "created_at", "mentions", "room_id")
+MESSAGE_PAGE_MAX = 200
+HISTORY_BATCH_SIZE = 50
+_EPOCH = datetime(1970, 1, 1)
+
+
+def message_cursor(message: dict) -> str:
+    millis = (message["created_at"] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}-{message['_id']}"
+
+
+def parse_message_cursor(cursor: str):
+    millis, _, message_id = cursor.partition("-")
+    try:
+        return _EPOCH + timedelta(milliseconds=int(millis)), ObjectId(message_id)
+    except Exception:
+        raise ValueError(f"invalid message cursor: {cursor}")
+
+
+class HistoryPage:
+    """Validated arguments of one history page: direction, keyset bound, projection."""
+
+    def __init__(self, limit: int = 50, before: str = None, after: str = None, fields: list[str] = None):
+        self.limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+        self.order = ASCENDING if after else DESCENDING
+        self.bound = parse_message_cursor(after or before) if (after or before) else None
+        self.projection = None
+        if fields:
+            unknown = set(fields) - set(MESSAGE_FIELDS)
+            if unknown:
+                raise ValueError(f"unknown message fields: {', '.join(sorted(unknown))}")
+            self.projection = {field: 1 for field in fields}
+            self.projection["created_at"] = 1
+
+    def key_query(self) -> dict:
+        if self.bound is None:
+            return {}
+        created_at, message_id = self.bound
+        op = "$gt" if self.order == ASCENDING else "$lt"
+        return {"$or": [{"created_at": {op: created_at}}, {"created_at": created_at, "_id": {op: message_id}}]}
+
+    def in_range(self, message: dict) -> bool:
+        if self.bound is None:
+            return True
+        key = (message["created_at"], message["_id"])
+        return key > self.bound if self.order == ASCENDING else key < self.bound
+
+    def project(self, message: dict) -> dict:
+        if self.projection is None:
+            return message
+        return {key: value for key, value in message.items() if key == "_id" or key in self.projection}
+
+
+class DocumentStore:
+    """One document per message in the `messages` collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def insert(self, message: dict):
+        await self.collection.insert_one(message)
+
+    async def insert_many(self, batch: list[dict]) -> tuple[list[dict], list[dict]]:
+        """Insert a batch and return (rows that need a retry, rows rejected by the server)."""
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            return [], []
+        except BulkWriteError as e:
+            # 重试时已经写入的行只会报重复 _id, 视为成功; 其它单行错误重试也不会成功
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+            return [], [batch[err["index"]] for err in errors]
+
+    async def iter_page(self, room_id: str, page: HistoryPage):
+        query = {"room_id": room_id, **page.key_query()}
+        cursor = (
+            self.collection.find(query, page.projection)
+            .sort([("created_at", page.order), ("_id", page.order)])
+            .limit(page.limit)
+            .batch_size(HISTORY_BATCH_SIZE)
+        )
+        async for message in cursor:
+            yield message
+
+    async def latest(self, room_ids: list[str]) -> dict:
+        """Newest message of each room, one indexed lookup per room run concurrently."""
+        rows = await asyncio.gather(*[self._latest(room_id) for room_id in room_ids])
+        return {room_id: row[0] for room_id, row in zip(room_ids, rows) if row}
+
+    async def _latest(self, room_id: str) -> list:
+        cursor = self.collection.find({"room_id": room_id}).sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+        return await cursor.limit(1).to_list(1)
+
+
+class BucketStore:
+    """Messages grouped per room into bucket documents.
+
+    A bucket holds at most BUCKET_SIZE messages spanning at most BUCKET_SPAN, with
+    `start`/`end` bounds used to pick the buckets of a history page.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def _append(self, room_id: str, messages: list[dict]):
+        first = min(message["created_at"] for message in messages)
+        last = max(message["created_at"] for message in messages)
+        await self.collection.update_one(
+            # 只追加到还放得下这批消息的桶, 否则新建一个
+            {"room_id": room_id, "count": {"$lte": BUCKET_SIZE - len(messages)}, "start": {"$gt": last - BUCKET_SPAN}},
+            {
+                "$push": {"messages": {"$each": messages}},
+                "$inc": {"count": len(messages)},
+                "$min": {"start": first},
+                "$max": {"end": last},
+            },
+            upsert=True,
+        )
+
+    async def insert(self, message: dict):
+        await self._append(message["room_id"], [message])
+
+    async def insert_many(self, batch: list[dict]) -> tuple[list[dict], list[dict]]:
+        """Append a batch and return (rows that need a retry, rows that cannot be stored)."""
+        rooms = {}
+        for message in batch:
+            rooms.setdefault(message["room_id"], []).append(message)
+        retry, rejected = [], []
+        for room_id, messages in rooms.items():
+            for i in range(0, len(messages), BUCKET_SIZE):
+                chunk = messages[i:i + BUCKET_SIZE]
+                try:
+                    await self._append(room_id, chunk)
+                except Exception as e:
+                    logging.warning(f"bucket append for room {room_id} failed: {e!r}")
+                    if is_transient(e):
+                        retry.extend(chunk)
+                    elif len(chunk) == 1:
+                        rejected.extend(chunk)
+                    else:
+                        # 整块被拒绝时逐条追加, 只丢弃写不进去的那条
+                        for message in chunk:
+                            chunk_retry, chunk_rejected = await self.insert_many([message])
+                            retry.extend(chunk_retry)
+                            rejected.extend(chunk_rejected)
+        return retry, rejected
+
+    async def iter_page(self, room_id: str, page: HistoryPage):
+        # 桶的时间范围可能有少量重叠, 收集到足够的候选后, 只要下一个桶不可能更近就停止
+        query = {"room_id": room_id}
+        if page.bound is not None and page.order == ASCENDING:
+            query["end"] = {"$gte": page.bound[0]}
+        elif page.bound is not None:
+            query["start"] = {"$lte": page.bound[0]}
+        edge = "start" if page.order == ASCENDING else "end"
+        reverse = page.order == DESCENDING
+        candidates = {}
+        cursor = self.collection.find(query).sort(edge, page.order).batch_size(4)
+        async for bucket in cursor:
+            if len(candidates) >= page.limit:
+                ranked = sorted(candidates.values(), key=_message_key, reverse=reverse)
+                boundary = ranked[page.limit - 1]["created_at"]
+                if (bucket[edge] > boundary) if page.order == ASCENDING else (bucket[edge] < boundary):
+                    break
+            for message in bucket.get("messages", []):
+                if page.in_range(message):
+                    # 重试可能写入重复消息, 按 _id 去重
+                    candidates[message["_id"]] = message
+        for message in sorted(candidates.values(), key=_message_key, reverse=reverse)[:page.limit]:
+            yield page.project(message)
+
+    async def latest(self, room_ids: list[str]) -> dict:
+        """Newest message of each room, taken from its newest bucket (one lookup per room)."""
+        rows = await asyncio.gather(*[self._latest(room_id) for room_id in room_ids])
+        return {
+            room_id: max(row[0]["messages"], key=_message_key)
+            for room_id, row in zip(room_ids, rows)
+            if row and row[0]["messages"]
+        }
+
+    async def _latest(self, room_id: str) -> list:
+        cursor = self.collection.find({"room_id": room_id}, {"messages": 1}).sort("end", DESCENDING)
+        return await cursor.limit(1).to_list(1)
+
+
+def _message_key(message: dict):
+    return message["created_at"], message["_id"]
+
+
+def create_message_store(kind: str = MESSAGE_STORAGE):
+    if kind == "document":
+        return DocumentStore(messages_collection)
+    if kind == "bucket":
+        return BucketStore(message_buckets_collection)
+    raise ValueError(f"unknown message storage: {kind}")
+
+
+message_store = create_message_store()
+
+
+class MessageWriter:
+    """Batches message writes into one store call per batch (group commit).
+
+    Messages carry client-assigned _ids, so retries are safe: the document store
+    ignores duplicate-key errors and bucket reads dedupe by _id. Transient errors
+    are retried with backoff; rows that can never be stored (bad BSON, too large,
+    rejected by the server) are logged and dropped.
+    """
+
+    def __init__(self, store, batch_size: int = WRITE_BATCH_SIZE, interval: float = WRITE_BATCH_INTERVAL):
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending: list[dict] = []
+        self.written = 0
+        self.failures = 0
+        self.rejected = 0
+        # 写入失败后的重试间隔, 成功后恢复为 interval
+        self.backoff = interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    def submit(self, message: dict):
+        self.pending.append(message)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        # 退避期间攒满一批也不提前唤醒, 等退避结束再重试
+        if len(self.pending) >= self.batch_size and self.backoff <= self.interval:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self.pending:
+                continue
+            try:
+                ok = await self.flush()
+            except Exception:
+                logging.exception("message write-behind: flush failed")
+                ok = False
+            if ok:
+                self.backoff = self.interval
+            else:
+                self.backoff = min(max(self.backoff, self.interval) * 2, WRITE_RETRY_MAX_BACKOFF)
+
+    async def flush(self) -> bool:
+        """Write everything pending; failed rows are put back in front for the next try."""
+        ok = True
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:len(batch)]
+            failed = await self._insert(batch)
+            if failed:
+                self.pending[:0] = failed
+                ok = False
+                break
+        return ok
+
+    async def _insert(self, batch: list[dict]) -> list[dict]:
+        """Write one batch; returns the rows to retry, rows that can never be written are dropped."""
+        try:
+            failed, rejected = await self.store.insert_many(batch)
+        except Exception as e:
+            logging.warning(f"message write-behind: insert failed: {e!r}")
+            if is_transient(e):
+                failed, rejected = batch, []
+            elif len(batch) == 1:
+                failed, rejected = [], batch
+            else:
+                # BSON 编码等错误针对整批, 逐条重写找出坏的那条
+                failed = []
+                for message in batch:
+                    failed.extend(await self._insert([message]))
+                return failed
+        self.written += len(batch) - len(failed) - len(rejected)
+        for message in rejected:
+            self.rejected += 1
+            logging.error(
+                f"message write-behind: dropping message {message.get('_id')} of room {message.get('room_id')}"
+            )
+        if failed:
+            self.failures += 1
+            logging.warning(f"message write-behind: {len(failed)} messages failed, will retry")
+        return failed
+
+    async def close(self):
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                logging.exception("message write-behind task failed")
+            self._task = None
+        for attempt in range(WRITE_CLOSE_RETRIES):
+            if await self.flush():
+                return
+            await asyncio.sleep(min(2 ** attempt * self.interval, WRITE_RETRY_MAX_BACKOFF))
+        logging.error(f"message write-behind: {len(self.pending)} messages could not be saved on shutdown")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "written": self.written,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "backoff": self.backoff,
+        }
+
+
+message_writer = MessageWriter(message_store)
 
 
 # 消息相关函数
@@ -17,6 +362,7 @@ async def save_message(
     content: str, sender_id: str, sender_username: str, room_id: str, mentions: list[dict] = None
 ):
     message = {
+        "_id": ObjectId(),
         "content": content,
         "sender_id": sender_id,
         "sender_username": sender_username,
@@ -24,19 +370,97 @@ async def save_message(
         "created_at": datetime.utcnow(),
         "mentions": mentions or []
     }
-    result = await messages_collection.insert_one(message)
-    message["id"] = str(result.inserted_id)
+    if WRITE_BEHIND:
+        message_writer.submit(dict(message))
+    else:
+        await message_store.insert(message)
+    message["id"] = str(message["_id"])
     return message
 
 
-async def get_room_messages(room_id: str, limit: int = 50):
-    cursor = messages_collection.find({"room_id": room_id})
-    cursor.sort("created_at", -1).limit(limit)
-    messages = await cursor.to_list(length=limit)
-    return messages
+def iter_room_messages(
+    room_id: str, limit: int = 50, before: str = None, after: str = None, fields: list[str] = None
+):
+    """Async iterator over one page of a room's history.
+
+    Without `after` the page is newest-first (older than `before` if given); with
+    `after` it is the oldest-first page of messages newer than that cursor. Arguments
+    are validated before returning, so a bad cursor raises ValueError here.
+    """
+    return message_store.iter_page(room_id, HistoryPage(limit, before, after, fields))
+
+
+async def get_room_messages(
+    room_id: str, limit: int = 50, before: str = None, after: str = None, fields: list[str] = None
+):
+    return [message async for message in iter_room_messages(room_id, limit, before, after, fields)]
+
+
+async def get_latest_messages(room_ids: list[str]) -> dict:
+    if not room_ids:
+        return {}
+    return await message_store.latest(room_ids)
 
 
 # 聊天室相关函数
+
+# 房间缓存: room_id -> CachedRoom, 创建房间和加入成员时同步更新本进程的缓存 (write-through)
+room_cache = AsyncCache(
+    "rooms",
+    maxsize=int(os.getenv("ROOM_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("ROOM_CACHE_TTL", "60")),
+    negative_ttl=float(os.getenv("ROOM_CACHE_NEGATIVE_TTL", "10")),
+)
+# 成员变化时通过 chat broker 通知其它 worker 清掉缓存; 消息带上本进程的标识, 自己发出的不处理
+ROOM_INVALIDATE_TOPIC = "rooms.invalidate"
+_ORIGIN = uuid.uuid4().hex
+_room_broker = None
+
+
+def _on_broker_message(topic: str, payload: bytes):
+    if topic == ROOM_INVALIDATE_TOPIC:
+        origin, _, room_id = payload.decode().partition(" ")
+        if origin != _ORIGIN:
+            room_cache.invalidate(room_id)
+
+
+def register_room_invalidation(broker):
+    """Publish room cache invalidations on `broker` and apply other workers' ones; called on startup."""
+    global _room_broker
+    _room_broker = broker
+    broker.subscribe(_on_broker_message)
+
+
+async def _publish_room_invalidation(room_id: str):
+    if _room_broker is not None:
+        await _room_broker.publish(ROOM_INVALIDATE_TOPIC, f"{_ORIGIN} {room_id}".encode())
+
+
+class CachedRoom:
+    __slots__ = ("room", "participants")
+
+    def __init__(self, room: dict):
+        self.room = room
+        self.participants = set(room.get("participants", []))
+
+    def copy_room(self) -> dict:
+        # 调用方会修改返回的房间文档, 返回副本
+        room = copy.copy(self.room)
+        room["participants"] = list(self.room.get("participants", []))
+        return room
+
+
+async def _load_room(room_id: str):
+    async def load():
+        room = await chat_rooms_collection.find_one({"_id": ObjectId(room_id)})
+        if room is None:
+            return None
+        room["id"] = str(room["_id"])
+        return CachedRoom(room)
+
+    return await room_cache.get_or_load(room_id, load)
+
+
 async def create_chat_room(name: str, creator_id: str):
     room = {
         "name": name,
@@ -47,15 +471,15 @@ async def create_chat_room(name: str, creator_id: str):
     }
     result = await chat_rooms_collection.insert_one(room)
     room["id"] = str(result.inserted_id)
+    room_cache.set(room["id"], CachedRoom(copy.deepcopy(room)))
+    # 其它 worker 可能缓存了这个 id 的"不存在"结果
+    await _publish_room_invalidation(room["id"])
     return room
 
 
 async def get_chat_room(room_id: str):
-    room = await chat_rooms_collection.find_one({"_id": ObjectId(room_id)})
-    if room:
-        room["id"] = str(room["_id"])
-        # Get usernames for participants
-    return room
+    cached = await _load_room(room_id)
+    return cached.copy_room() if cached else None
 
 
 async def add_participant_to_room(room_id: str, user_id: str):
@@ -63,19 +487,42 @@ async def add_participant_to_room(room_id: str, user_id: str):
     await chat_rooms_collection.update_one(
         {"_id": ObjectId(room_id)}, {"$addToSet": {"participants": user_id}}
     )
+    found, cached = room_cache.lookup(room_id)
+    if found and cached is not None:
+        if user_id not in cached.participants:
+            cached.participants.add(user_id)
+            cached.room["participants"].append(user_id)
+    else:
+        room_cache.invalidate(room_id)
+    await _publish_room_invalidation(room_id)
+
+
+async def get_room_participants(room_id: str) -> set:
+    cached = await _load_room(room_id)
+    return set(cached.participants) if cached else set()
+
 
+async def is_room_participant(room_id: str, user_id: str) -> bool:
+    cached = await _load_room(room_id)
+    return cached is not None and user_id in cached.participants
 
 
-async def get_room_participants(room_id: str):
-    room = await get_chat_room(room_id)
-    return room["participants"]
+ROOM_PAGE_MAX = 100
 
 
-async def get_chat_rooms(user_id: str):
-    rooms = await chat_rooms_collection.find({"participants": user_id}).to_list(length=100)
+async def get_chat_rooms(user_id: str, limit: int = ROOM_PAGE_MAX, before: str = None):
+    """Rooms of a user, newest first; pass the last room id as `before` for the next page."""
+    query = {"participants": user_id}
+    if before:
+        try:
+            query["_id"] = {"$lt": ObjectId(before)}
+        except Exception:
+            raise ValueError(f"invalid room cursor: {before}")
+    limit = max(1, min(limit, ROOM_PAGE_MAX))
+    rooms = await chat_rooms_collection.find(query).sort("_id", DESCENDING).limit(limit).to_list(length=limit)
     for room in rooms:
         room["id"] = str(room["_id"])
     return rooms
 
 async def get_chat_room_by_id(room_id: str):
-    return await chat_rooms_collection.find_one({"_id": ObjectId(room_id)})
+    return await get_chat_room(room_id)
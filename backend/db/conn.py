@@ -1,11 +1,135 @@
 import os
+import threading
+import time
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 
 
 # MongoDB连接
 MONGODB_URI = os.getenv("MONGODB_URI")
-client = AsyncIOMotorClient(MONGODB_URI)
+# 存储后端: mongo 连接 MONGODB_URI, memory 使用进程内的内存实现 (压测和隔离环境用, 重启后数据丢失)
+MONGODB_BACKEND = os.getenv("MONGODB_BACKEND", "mongo")
+# 连接池配置
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "0"))
+# 例如 "zstd,snappy,zlib", 需要服务端和对应的压缩库支持
+MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS", "")
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool counters and checkout latency, fed by pymongo's CMAP events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.open = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_time_total = 0.0
+        self.checkout_time_max = 0.0
+        self.pool_clears = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open": self.open,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "max_pool_size": MONGODB_MAX_POOL_SIZE,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_ms_avg": self.checkout_time_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                "checkout_ms_max": self.checkout_time_max * 1000,
+                "pool_clears": self.pool_clears,
+            }
+
+    def _checkout_duration(self, event) -> float:
+        # pymongo >= 4.7 会在事件里带上 duration, 否则用同一线程里记录的开始时间
+        duration = getattr(event, "duration", None)
+        if duration is None:
+            started = getattr(self._local, "started", None)
+            duration = time.perf_counter() - started if started is not None else 0.0
+        self._local.started = None
+        return duration
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        duration = self._checkout_duration(event)
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.checkout_time_total += duration
+            self.checkout_time_max = max(self.checkout_time_max, duration)
+
+    def connection_check_out_failed(self, event):
+        self._checkout_duration(event)
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+
+pool_metrics = PoolMetrics()
+
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": MONGODB_MIN_POOL_SIZE,
+        "event_listeners": [pool_metrics],
+    }
+    if MONGODB_WAIT_QUEUE_TIMEOUT_MS > 0:
+        options["waitQueueTimeoutMS"] = MONGODB_WAIT_QUEUE_TIMEOUT_MS
+    if MONGODB_COMPRESSORS:
+        options["compressors"] = MONGODB_COMPRESSORS
+    return options
+
+
+def create_client(kind: str = MONGODB_BACKEND):
+    if kind == "mongo":
+        return AsyncIOMotorClient(MONGODB_URI, **client_options())
+    if kind == "memory":
+        from backend.db.memory import MemoryClient
+
+        return MemoryClient()
+    raise ValueError(f"unknown mongodb backend: {kind}")
+
+
+# 整个进程共用一个客户端和连接池
+client = create_client()
 db = client.chat_db
 
 
@@ -17,6 +141,3 @@ tokens_collection = db.tokens
 # 数据库集合
 messages_collection = db.messages
 chat_rooms_collection = db.chat_rooms
-
-
-
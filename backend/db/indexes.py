@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import logging
+import os
+from typing import List
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+from backend.db.conn import db
+
+# 启动时检查热点查询的执行计划, 出现 COLLSCAN 时启动失败
+CHECK_QUERY_PLANS = os.getenv("MONGODB_CHECK_QUERY_PLANS", "false").lower() in ("1", "true", "yes")
+
+# 各集合需要的索引
+INDEXES = {
+    "messages": [
+        IndexModel(
+            [("room_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="room_id_created_at_id",
+        ),
+    ],
+    "message_buckets": [
+        IndexModel([("room_id", ASCENDING), ("end", DESCENDING)], name="room_id_end"),
+        IndexModel([("room_id", ASCENDING), ("start", ASCENDING)], name="room_id_start"),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email"),
+        IndexModel([("role", ASCENDING)], name="role"),
+    ],
+    "tokens": [
+        IndexModel([("token", ASCENDING)], name="token_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username"),
+        # expires 到期后由 MongoDB 自动删除
+        IndexModel([("expires", ASCENDING)], name="expires_ttl", expireAfterSeconds=0),
+    ],
+    "chat_rooms": [
+        IndexModel([("participants", ASCENDING), ("_id", DESCENDING)], name="participants_id"),
+    ],
+}
+
+
+def hot_queries():
+    """(name, cursor) for every query on the request path, built with placeholder values."""
+    user_id = str(ObjectId())
+    return [
+        (
+            "get_room_messages",
+            db.messages.find({"room_id": user_id}).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(50),
+        ),
+        (
+            "get_room_message_buckets",
+            db.message_buckets.find({"room_id": user_id}).sort("end", DESCENDING).limit(2),
+        ),
+        ("get_user_by_username", db.users.find({"username": "_"}).limit(1)),
+        ("get_user_by_email", db.users.find({"email": "_"}).limit(1)),
+        ("get_users_by_role", db.users.find({"role": "mcp"})),
+        ("get_users_by_ids", db.users.find({"_id": {"$in": [ObjectId()]}})),
+        ("get_token", db.tokens.find({"token": "_"}).limit(1)),
+        ("delete_user_tokens", db.tokens.find({"username": "_"})),
+        ("get_chat_rooms", db.chat_rooms.find({"participants": user_id}).sort("_id", DESCENDING).limit(100)),
+    ]
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+async def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        try:
+            names = await db[collection].create_indexes(indexes)
+            logging.info(f"indexes ready on {collection}: {names}")
+        except PyMongoError as e:
+            logging.error(f"failed to create indexes on {collection}: {e}")
+
+
+def _stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_stages(value))
+    return stages
+
+
+async def check_query_plans():
+    """Explain every hot query and raise QueryPlanError if any winning plan is a COLLSCAN."""
+    failed = []
+    for name, cursor in hot_queries():
+        explain = await cursor.explain()
+        stages = _stages(explain["queryPlanner"]["winningPlan"])
+        logging.info(f"query plan {name}: {' <- '.join(stages)}")
+        if "COLLSCAN" in stages:
+            failed.append(name)
+    if failed:
+        raise QueryPlanError(f"queries fall back to COLLSCAN: {', '.join(failed)}")
+
+
+async def init_indexes():
+    await ensure_indexes()
+    if CHECK_QUERY_PLANS:
+        await check_query_plans()
+
+
+async def main(check: bool):
+    await ensure_indexes()
+    if check:
+        await check_query_plans()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="create MongoDB indexes")
+    parser.add_argument("--check", action="store_true", help="fail if a hot query plan falls back to COLLSCAN")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.check))
@@ -0,0 +1,468 @@
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+DUPLICATE_KEY = 11000
+_MISSING = object()
+
+
+def _encode(value):
+    """Copy a value the way a BSON round trip would: datetimes keep only milliseconds."""
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _get(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _compare(value, op: str, operand) -> bool:
+    if value is _MISSING or value is None:
+        return False
+    try:
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+        if op == "$gt":
+            return value > operand
+        return value >= operand
+    except TypeError:
+        return False
+
+
+def _match_value(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for op, operand in condition.items():
+            if op in ("$lt", "$lte", "$gt", "$gte"):
+                # 数组字段只要有一个元素满足即可
+                values = value if isinstance(value, list) else [value]
+                if not any(_compare(v, op, operand) for v in values):
+                    return False
+            elif op == "$in":
+                if not any(_match_value(value, candidate) for candidate in operand):
+                    return False
+            elif op == "$nin":
+                if any(_match_value(value, candidate) for candidate in operand):
+                    return False
+            elif op == "$ne":
+                if _match_value(value, operand):
+                    return False
+            elif op == "$exists":
+                if (value is not _MISSING) != bool(operand):
+                    return False
+            else:
+                raise NotImplementedError(f"memory backend does not support {op}")
+        return True
+    if value is _MISSING:
+        return condition is None
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def match(doc: dict, query: Optional[dict]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(match(doc, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(match(doc, sub) for sub in condition):
+                return False
+        elif not _match_value(_get(doc, key), condition):
+            return False
+    return True
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    include = {key for key, value in projection.items() if value and key != "_id"}
+    if include:
+        result = {key: value for key, value in doc.items() if key in include}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {key: value for key, value in doc.items() if projection.get(key, 1)}
+
+
+def _sort_spec(key_or_list, direction=None) -> List[tuple]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else ASCENDING)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def _sort_key(value):
+    return (0,) if value is _MISSING or value is None else (1, value)
+
+
+def _sort(docs: List[dict], spec: List[tuple]) -> List[dict]:
+    # 逐个键做稳定排序, 缺失的字段排在最前
+    for key, direction in reversed(spec):
+        docs.sort(key=lambda doc: _sort_key(_get(doc, key)), reverse=direction < 0)
+    return docs
+
+
+class MemoryCursor:
+    """Lazily evaluated result set with the motor cursor methods the project uses."""
+
+    def __init__(self, load):
+        self._load = load
+        self._sort: List[tuple] = []
+        self._skip = 0
+        self._limit = 0
+        self._results: Optional[List[dict]] = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def _evaluate(self) -> List[dict]:
+        if self._results is None:
+            self._results = self._load(self._sort, self._skip, self._limit)
+        return self._results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._evaluate():
+            yield doc
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        docs = self._evaluate()
+        return list(docs if length is None else docs[:length])
+
+    async def explain(self) -> dict:
+        return {"queryPlanner": {"winningPlan": {"stage": "MEMORY_SCAN"}}}
+
+
+def _apply_update(doc: dict, update: dict):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            current = doc.get(key, _MISSING)
+            if op == "$set":
+                doc[key] = _encode(value)
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op == "$inc":
+                doc[key] = (0 if current is _MISSING else current) + value
+            elif op == "$min":
+                value = _encode(value)
+                if current is _MISSING or value < current:
+                    doc[key] = value
+            elif op == "$max":
+                value = _encode(value)
+                if current is _MISSING or value > current:
+                    doc[key] = value
+            elif op in ("$push", "$addToSet"):
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                array = doc.setdefault(key, [])
+                for item in map(_encode, items):
+                    if op == "$push" or item not in array:
+                        array.append(item)
+            elif op == "$pull":
+                doc[key] = [item for item in doc.get(key, []) if not _match_value(item, value)]
+            else:
+                raise NotImplementedError(f"memory backend does not support {op}")
+
+
+def _group_key(doc: dict, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get(doc, expression[1:])
+        return None if value is _MISSING else value
+    return expression
+
+
+def _expression(doc: dict, expression):
+    if expression == "$$ROOT":
+        return doc
+    return _group_key(doc, expression)
+
+
+def _group(docs: List[dict], spec: dict) -> List[dict]:
+    groups: Dict[Any, dict] = {}
+    for doc in docs:
+        key = _group_key(doc, spec["_id"])
+        group_key = repr(key)
+        group = groups.get(group_key)
+        if group is None:
+            group = groups[group_key] = {"_id": key}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (op, expression), = accumulator.items()
+            value = _expression(doc, expression)
+            if op == "$first":
+                group.setdefault(field, value)
+            elif op == "$last":
+                group[field] = value
+            elif op == "$sum":
+                group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif op == "$push":
+                group.setdefault(field, []).append(value)
+            elif op in ("$min", "$max"):
+                if field not in group or (value < group[field] if op == "$min" else value > group[field]):
+                    group[field] = value
+            else:
+                raise NotImplementedError(f"memory backend does not support {op}")
+    return list(groups.values())
+
+
+def _slice(docs: list, skip: int, limit: int) -> list:
+    docs = docs[skip:] if skip else docs
+    return docs[:limit] if limit else docs
+
+
+def _index_value(value):
+    if value is _MISSING:
+        return None
+    # 数组和文档不可哈希, 用 repr 作为索引键
+    return repr(value) if isinstance(value, (dict, list)) else value
+
+
+class MemoryCollection:
+    """Async in-memory stand-in for an AsyncIOMotorCollection.
+
+    Documents are copied on the way in and out so callers can mutate them as they
+    would a driver result, and datetimes are cut to milliseconds like BSON does.
+    Unique indexes are enforced; other indexes are accepted and ignored.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._docs: Dict[Any, dict] = {}
+        # 唯一索引: name -> (字段列表, 索引值 -> _id)
+        self._unique: Dict[str, Tuple[List[str], Dict[tuple, Any]]] = {}
+        self._lock = threading.RLock()
+
+    def _snapshot(self, query: Optional[dict], projection: Optional[dict] = None):
+        def load(sort_spec: List[tuple], skip: int = 0, limit: int = 0) -> List[dict]:
+            with self._lock:
+                docs = [doc for doc in self._docs.values() if match(doc, query)]
+                if sort_spec:
+                    docs = _sort(docs, sort_spec)
+                # 先排序和截取, 只复制返回的那一页
+                return [_encode(_project(doc, projection)) for doc in _slice(docs, skip, limit)]
+
+        return load
+
+    def _index_keys(self, doc: dict) -> Dict[str, tuple]:
+        return {
+            name: tuple(_index_value(_get(doc, key)) for key in keys)
+            for name, (keys, _) in self._unique.items()
+        }
+
+    def _check_unique(self, doc: dict, ignore_id=_MISSING):
+        if doc["_id"] in self._docs and doc["_id"] != ignore_id:
+            raise DuplicateKeyError(f"duplicate key on {self.name}._id: {doc['_id']}", DUPLICATE_KEY)
+        for name, value in self._index_keys(doc).items():
+            owner = self._unique[name][1].get(value, _MISSING)
+            if owner is not _MISSING and owner != ignore_id:
+                raise DuplicateKeyError(f"duplicate key on {self.name}.{name}: {list(value)}", DUPLICATE_KEY)
+
+    def _store(self, doc: dict):
+        self._docs[doc["_id"]] = doc
+        for name, value in self._index_keys(doc).items():
+            self._unique[name][1][value] = doc["_id"]
+
+    def _unstore(self, doc_id):
+        doc = self._docs.pop(doc_id)
+        for name, value in self._index_keys(doc).items():
+            entries = self._unique[name][1]
+            if entries.get(value) == doc_id:
+                del entries[value]
+
+    def _insert(self, document: dict):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        doc = _encode(document)
+        self._check_unique(doc)
+        self._store(doc)
+
+    async def insert_one(self, document: dict) -> InsertOneResult:
+        with self._lock:
+            self._insert(document)
+        return InsertOneResult(document["_id"], True)
+
+    async def insert_many(self, documents: List[dict], ordered: bool = True) -> InsertManyResult:
+        errors = []
+        inserted = 0
+        with self._lock:
+            for index, document in enumerate(documents):
+                try:
+                    self._insert(document)
+                    inserted += 1
+                except DuplicateKeyError as e:
+                    errors.append({"index": index, "code": DUPLICATE_KEY, "errmsg": str(e), "op": document})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": inserted})
+        return InsertManyResult([document["_id"] for document in documents], True)
+
+    def find(self, filter: Optional[dict] = None, projection: Optional[dict] = None) -> MemoryCursor:
+        return MemoryCursor(self._snapshot(filter, projection))
+
+    async def find_one(self, filter: Optional[dict] = None, projection: Optional[dict] = None):
+        docs = await self.find(filter, projection).limit(1).to_list(1)
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter: dict) -> int:
+        with self._lock:
+            return sum(1 for doc in self._docs.values() if match(doc, filter))
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        with self._lock:
+            for doc in self._docs.values():
+                if match(doc, filter):
+                    updated = _encode(doc)
+                    _apply_update(updated, update)
+                    self._check_unique(updated, ignore_id=doc["_id"])
+                    modified = updated != doc
+                    self._unstore(doc["_id"])
+                    self._store(updated)
+                    return UpdateResult({"n": 1, "nModified": int(modified), "updatedExisting": True}, True)
+            if not upsert:
+                return UpdateResult({"n": 0, "nModified": 0, "updatedExisting": False}, True)
+            # upsert: 用过滤条件里的等值字段作为新文档的初始值
+            doc = {
+                key: value
+                for key, value in filter.items()
+                if not key.startswith("$") and not (isinstance(value, dict) and any(k.startswith("$") for k in value))
+            }
+            _apply_update(doc, update)
+            self._insert(doc)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": doc["_id"], "updatedExisting": False}, True)
+
+    async def _delete(self, filter: dict, many: bool) -> DeleteResult:
+        with self._lock:
+            ids = [doc_id for doc_id, doc in self._docs.items() if match(doc, filter)]
+            if not many:
+                ids = ids[:1]
+            for doc_id in ids:
+                self._unstore(doc_id)
+        return DeleteResult({"n": len(ids)}, True)
+
+    async def delete_one(self, filter: dict) -> DeleteResult:
+        return await self._delete(filter, many=False)
+
+    async def delete_many(self, filter: dict) -> DeleteResult:
+        return await self._delete(filter, many=True)
+
+    def aggregate(self, pipeline: List[dict]) -> MemoryCursor:
+        def load(sort_spec: List[tuple], skip: int = 0, limit: int = 0) -> List[dict]:
+            stages = list(pipeline)
+            with self._lock:
+                docs = list(self._docs.values())
+                # 开头的 $match 直接在原文档上过滤, 只复制留下的文档
+                while stages and "$match" in stages[0]:
+                    query = stages.pop(0)["$match"]
+                    docs = [doc for doc in docs if match(doc, query)]
+                docs = [_encode(doc) for doc in docs]
+            for stage in stages:
+                (op, spec), = stage.items()
+                if op == "$match":
+                    docs = [doc for doc in docs if match(doc, spec)]
+                elif op == "$sort":
+                    docs = _sort(docs, _sort_spec(spec))
+                elif op == "$group":
+                    docs = _group(docs, spec)
+                elif op == "$project":
+                    docs = [_project(doc, spec) for doc in docs]
+                elif op == "$skip":
+                    docs = docs[spec:]
+                elif op == "$limit":
+                    docs = docs[:spec]
+                else:
+                    raise NotImplementedError(f"memory backend does not support {op}")
+            return _slice(_sort(docs, sort_spec) if sort_spec else docs, skip, limit)
+
+        return MemoryCursor(load)
+
+    async def create_indexes(self, indexes) -> List[str]:
+        names = []
+        with self._lock:
+            for index in indexes:
+                document = index.document
+                if document.get("unique") and document["name"] not in self._unique:
+                    keys = list(document["key"].keys())
+                    entries = {
+                        tuple(_index_value(_get(doc, key)) for key in keys): doc_id
+                        for doc_id, doc in self._docs.items()
+                    }
+                    self._unique[document["name"]] = (keys, entries)
+                names.append(document["name"])
+        return names
+
+    async def drop(self):
+        with self._lock:
+            self._docs.clear()
+            for _, entries in self._unique.values():
+                entries.clear()
+
+
+class MemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(name)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+class MemoryClient:
+    """Process-local replacement for AsyncIOMotorClient; data is lost on exit."""
+
+    def __init__(self):
+        self._databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(name)
+        return database
+
+    def __getattr__(self, name: str) -> MemoryDatabase:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def close(self):
+        pass
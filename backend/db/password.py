@@ -0,0 +1,102 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+
+from passlib.context import CryptContext
+
+# 密码哈希
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt 在独立线程池里执行 (计算时会释放 GIL), 不阻塞事件循环
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 排队加执行中的任务上限, 超过后直接拒绝
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs bcrypt hash/verify on a bounded thread pool.
+
+    At most `max_pending` operations may be queued or running; further calls raise
+    PasswordHasherBusy instead of piling up behind a login flood.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(pwd_context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit(pwd_context.verify, password, hashed)
+
+    async def _submit(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordHasherBusy(f"{self.pending} password operations pending")
+            self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._run, time.perf_counter(), fn, *args
+        )
+        # 请求被取消时线程里的计算仍在进行, 名额等计算结束后再释放
+        future.add_done_callback(self._release)
+        return await asyncio.shield(future)
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _run(self, submitted: float, fn, *args):
+        started = time.perf_counter()
+        with self._lock:
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            waited = started - submitted
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+                self.hash_time_total += elapsed
+                self.hash_time_max = max(self.hash_time_max, elapsed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "queued": self.pending - self.running,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_ms_avg": self.wait_time_total / self.completed * 1000 if self.completed else 0.0,
+                "wait_ms_max": self.wait_time_max * 1000,
+                "hash_ms_avg": self.hash_time_total / self.completed * 1000 if self.completed else 0.0,
+                "hash_ms_max": self.hash_time_max * 1000,
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher()
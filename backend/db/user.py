@@ -1,13 +1,31 @@
+import copy
 from datetime import datetime
+import os
 
 from bson import ObjectId
-from passlib.context import CryptContext
 
+from backend.cache import AsyncCache
 from backend.db.conn import users_collection, tokens_collection
+from backend.db.password import password_hasher
 from backend.model.model import User, UserRole
 
-# 密码哈希
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 用户查询缓存: 按 username 和 id 缓存用户文档, 不存在的用户也短暂缓存
+user_cache = AsyncCache(
+    "users",
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "300")),
+    negative_ttl=float(os.getenv("USER_CACHE_NEGATIVE_TTL", "30")),
+)
+
+
+def _cache_user(user: dict):
+    user_cache.set(("username", user["username"]), user)
+    user_cache.set(("id", str(user["_id"])), user)
+
+
+def invalidate_user(user: dict):
+    user_cache.invalidate(("username", user["username"]))
+    user_cache.invalidate(("id", str(user["_id"])))
 
 
 
@@ -16,7 +34,14 @@ async def get_users_by_role(role: UserRole):
 
 
 async def get_user_by_username(username: str):
-    return await users_collection.find_one({"username": username})
+    async def load():
+        user = await users_collection.find_one({"username": username})
+        if user is not None:
+            user_cache.set(("id", str(user["_id"])), user)
+        return user
+
+    # 调用方会修改返回的文档, 返回副本
+    return copy.copy(await user_cache.get_or_load(("username", username), load))
 
 async def get_user_by_email(email: str):
     return await users_collection.find_one({"email": email})
@@ -26,18 +51,20 @@ async def create_user(user: User):
     user_dict = {
         "username": user.username,
         "email": user.email,
-        "password": pwd_context.hash(user.password),
+        "password": await password_hasher.hash(user.password),
         "created_at": datetime.utcnow(),
         "role": user.role,
         "mcp_sse_url": user.mcp_sse_url,
     }
+    user_cache.invalidate(("username", user.username))
     result = await users_collection.insert_one(user_dict)
+    _cache_user(dict(user_dict))
     user_dict["id"] = str(result.inserted_id)
     return user_dict
 
 
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str):
+    return await password_hasher.verify(plain_password, hashed_password)
 
 
 async def delete_user_tokens(username: str):
@@ -59,7 +86,10 @@ async def delete_token(token: str):
 
 
 async def get_user_by_id(user_id: str):
-    return await users_collection.find_one({"_id": ObjectId(user_id)})
+    async def load():
+        return await users_collection.find_one({"_id": ObjectId(user_id)})
+
+    return copy.copy(await user_cache.get_or_load(("id", str(user_id)), load))
 
 
 async def search_user(username: str, user_id: str):
@@ -68,4 +98,23 @@ async def search_user(username: str, user_id: str):
     ).to_list(length=100)
 
 async def get_users_by_ids(user_ids: list[str]):
-    return await users_collection.find({"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}}).to_list(length=100)
+    users = {}
+    missing = []
+    for user_id in dict.fromkeys(str(user_id) for user_id in user_ids):
+        found, user = user_cache.get(("id", user_id))
+        if not found:
+            missing.append(user_id)
+        elif user is not None:
+            users[user_id] = user
+    if missing:
+        # 未命中的 id 合并成一次查询
+        fetched = await users_collection.find(
+            {"_id": {"$in": [ObjectId(user_id) for user_id in missing]}}
+        ).to_list(length=None)
+        for user in fetched:
+            _cache_user(user)
+            users[str(user["_id"])] = user
+        for user_id in missing:
+            if user_id not in users:
+                user_cache.set(("id", user_id), None)
+    return [copy.copy(user) for user in users.values()]
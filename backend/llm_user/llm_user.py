@@ -13,10 +13,12 @@ from backend.chat_room import room_chat
 from backend.db.chat_room import (
     add_participant_to_room,
     get_chat_room,
-    get_room_participants,
+    is_room_participant,
 )
 from backend.db.user import create_user, get_user_by_username, get_users_by_ids
 from backend.llm_user.mcp_user import McpUser, get_mcp_user, get_room_mcp_users
+from backend.llm_user.task_exec import ToolTask, tool_executor
+from backend.llm_user.tool_schema import tool_schema_registry
 from backend.model.model import User, UserRole
 from openai import OpenAI
 
@@ -64,33 +66,6 @@ ext_tools:
 """
 
 
-class ParameterProperty(BaseModel):
-    type: str
-    description: Optional[str] = None
-
-
-class Parameters(BaseModel):
-    type: str = "object"
-    properties: Dict[str, ParameterProperty]
-    required: List[str] = []
-
-
-class FunctionSchema(BaseModel):
-    name: str
-    description: str
-    parameters: Parameters
-
-
-class ToolDescription(BaseModel):
-    type: str = "function"
-    function: FunctionSchema
-
-
-class McpTool(BaseModel):
-    desc: ToolDescription
-    func: Callable
-
-
 def call_tool(tool: Tool, args: dict):
     pass
 
@@ -101,24 +76,6 @@ def call_tool(tool: Tool, args: dict):
 # return {"status": "success", "result": result}
 
 
-def get_tool_description(tool: Tool) -> ToolDescription:
-    return ToolDescription(
-        type="function",
-        function=FunctionSchema(
-            name=tool.name,
-            description=tool.description,
-            parameters=Parameters(
-                type="object",
-                properties={
-                    k: ParameterProperty(type=v["type"], description=v["title"])
-                    for k, v in tool.inputSchema["properties"].items()
-                },
-                required=list(tool.inputSchema["required"]),
-            ),
-        ),
-    )
-
-
 class LlmUser:
     def __init__(self, user_name: str):
         self.user_name = user_name
@@ -151,64 +108,68 @@ class LlmUser:
         asyncio.create_task(self.task_enter_room())
 
     async def task_chat(self) -> None:
+        # 只接收 @ 了自己的消息
+        inbox = room_chat.chat_room_manager.subscribe_mentions(self.user_id)
         while True:
-            message = await room_chat.chat_room_manager.global_message_queue.get()
+            message = await inbox.get()
             content = message["data"]["content"]
             sender_id = message["data"]["sender_id"]
             room_id = message["data"]["room_id"]
-            mentions = [m["user_id"] for m in message["data"]["mentions"]]
-            if self.user_id in mentions:
-                # 回复消息
+            # 回复消息
 
-                mcp_users = await get_room_mcp_users(room_id)
-                all_tools = await asyncio.gather(
-                    *[user.list_tools() for user in mcp_users]
-                )
-                tool2mcp={}
-                tools = []
-                for mcp_tools,mcp in zip(all_tools,mcp_users):
-                    tools.extend(mcp_tools)
-                    tool2mcp= tool2mcp | {tool.name:mcp for tool in mcp_tools}
-
-                response = self.llm.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {"role": "user", "content": content},
-                    ],
-                    tools=(
-                        [get_tool_description(tool) for tool in tools]
-                        if tools
-                        else None
-                    ),
-                )
+            mcp_users = await get_room_mcp_users(room_id)
+            # 工具目录来自内存缓存, 连不上的服务器跳过
+            catalogs = await asyncio.gather(
+                *[user.get_catalog() for user in mcp_users], return_exceptions=True
+            )
+            servers = []
+            for catalog,mcp in zip(catalogs,mcp_users):
+                if isinstance(catalog, BaseException):
+                    logging.warning(f"mcp server {mcp.user_name} unavailable: {catalog!r}")
+                    continue
+                servers.append((mcp.user_name, catalog))
+            # 按目录版本缓存的工具描述和路由表
+            toolset = tool_schema_registry.toolset(servers)
+
+            response = self.llm.chat.completions.create(
+                model="deepseek-chat",
+                messages=[
+                    {"role": "user", "content": content},
+                ],
+                tools=toolset.specs or None,
+            )
 
-                tool_calls = response.choices[0].message.tool_calls
-                if tool_calls:
-                    for tool_call in tool_calls:
-                        print(tool_call)
-                        func = tool_call.function
-                        content={
-                            "mcp_id":tool2mcp[func.name].user_name,
-                            "func_name":func.name,
-                            "args":json.loads(func.arguments),
-                        }
-
-                        await room_chat.chat_room_manager.send_message(json.dumps(content,ensure_ascii=False),self.user_id,self.user_name,room_id)
-
-                else:
-                    content = response.choices[0].message.content
+            tool_calls = response.choices[0].message.tool_calls
+            if tool_calls:
+                # 各个工具调用并发执行, 结果按调用顺序发到房间
+                mcp_by_name = {mcp.user_name: mcp for mcp in mcp_users}
+                tasks = [
+                    ToolTask(
+                        tool_call.function.name,
+                        tool_call.function.arguments,
+                        mcp_by_name.get(toolset.tool2mcp.get(tool_call.function.name)),
+                    )
+                    for tool_call in tool_calls
+                ]
+                for task in await tool_executor.run(tasks):
+                    sender_id, sender_name = (task.mcp.user_id, task.mcp.user_name) if task.mcp else (self.user_id, self.user_name)
                     await room_chat.chat_room_manager.send_message(
-                        content, self.user_id, self.user_name, room_id
+                        json.dumps(task.to_message(), ensure_ascii=False), sender_id, sender_name, room_id
                     )
 
+            else:
+                content = response.choices[0].message.content
+                await room_chat.chat_room_manager.send_message(
+                    content, self.user_id, self.user_name, room_id
+                )
+
             # room_chat.chat_room_manager.send_message("你好。我是llm",self.user_id,self.user_name,message["room_id"],mentions=message['sender_id'])
 
     async def task_enter_room(self) -> None:
         while True:
             message = await room_chat.chat_room_manager.enter_room_queue.get()
             _, room_id = message
-            room_participants = await get_room_participants(room_id)
-            if self.user_id not in room_participants:
+            if not await is_room_participant(room_id, self.user_id):
                 await add_participant_to_room(room_id=room_id, user_id=self.user_id)
 
 
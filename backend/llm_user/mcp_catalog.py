@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Dict, List
+
+from mcp.shared.exceptions import McpError
+from mcp.types import (
+    Prompt,
+    PromptListChangedNotification,
+    Resource,
+    ResourceListChangedNotification,
+    ResourceTemplate,
+    Tool,
+    ToolListChangedNotification,
+)
+
+from backend.llm_user.mcp_pool import REQUEST_TIMEOUT_CODE, McpSessionPool, mcp_pool
+
+# 工具目录缓存时间, 过期后先返回旧目录, 同时在后台刷新
+MCP_CATALOG_TTL = float(os.getenv("MCP_CATALOG_TTL", "300"))
+
+LIST_CHANGED = (ToolListChangedNotification, PromptListChangedNotification, ResourceListChangedNotification)
+
+# 工具列表每次变化分配一个新的版本号, 编译好的工具描述按版本缓存
+_versions = itertools.count(1)
+
+
+class Catalog:
+    """Tools, prompts and resources of one MCP server at a point in time."""
+
+    def __init__(
+        self,
+        url: str,
+        tools: List[Tool],
+        prompts: List[Prompt],
+        resources: List[Resource],
+        resource_templates: List[ResourceTemplate],
+        version: int,
+    ):
+        self.url = url
+        self.tools = tools
+        self.prompts = prompts
+        self.resources = resources
+        self.resource_templates = resource_templates
+        self.version = version
+        self.fetched_at = time.monotonic()
+
+    @property
+    def stale(self) -> bool:
+        return time.monotonic() - self.fetched_at > MCP_CATALOG_TTL
+
+
+async def _optional(request, attr: str) -> list:
+    # 服务端不支持 prompts/resources 时返回空列表
+    try:
+        return getattr(await request, attr)
+    except McpError as e:
+        if e.error.code == REQUEST_TIMEOUT_CODE:
+            raise
+        return []
+
+
+class McpCatalog:
+    """Per-server catalog cache.
+
+    Callers get the cached catalog straight from memory. A stale catalog is still
+    returned while a background refresh runs, and a list_changed notification from
+    the server drops the entry and reloads it.
+    """
+
+    def __init__(self, pool: McpSessionPool):
+        self.pool = pool
+        self.catalogs: Dict[str, Catalog] = {}
+        self._loads: Dict[str, asyncio.Task] = {}
+        self.loads = 0
+        self.failures = 0
+        self.notifications = 0
+        pool.subscribe(self._on_notification)
+
+    async def get(self, url: str) -> Catalog:
+        while True:
+            catalog = self.catalogs.get(url)
+            if catalog is not None:
+                if catalog.stale:
+                    self._load(url)
+                return catalog
+            task = self._load(url)
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # 加载被 list_changed 作废时重新等待新的加载
+                if not task.cancelled():
+                    raise
+
+    def invalidate(self, url: str):
+        self.catalogs.pop(url, None)
+        # 正在进行的加载可能拿到旧列表, 作废后重新加载
+        task = self._loads.pop(url, None)
+        if task is not None:
+            task.cancel()
+
+    def _on_notification(self, url: str, notification):
+        if isinstance(notification, LIST_CHANGED):
+            self.notifications += 1
+            logging.info(f"mcp catalog of {url} changed, reloading")
+            self.invalidate(url)
+            self._load(url)
+
+    def _load(self, url: str) -> asyncio.Task:
+        # 同一个服务器同时只有一个加载任务
+        task = self._loads.get(url)
+        if task is None:
+            task = self._loads[url] = asyncio.create_task(self._fetch(url))
+            task.add_done_callback(lambda done: self._loaded(url, done))
+        return task
+
+    def _loaded(self, url: str, task: asyncio.Task):
+        if self._loads.get(url) is task:
+            del self._loads[url]
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+            logging.warning(f"failed to load mcp catalog of {url}: {task.exception()!r}")
+
+    async def _fetch(self, url: str) -> Catalog:
+        async with self.pool.session(url) as session:
+            tools = (await session.list_tools()).tools
+            prompts = await _optional(session.list_prompts(), "prompts")
+            resources = await _optional(session.list_resources(), "resources")
+            resource_templates = await _optional(session.list_resource_templates(), "resourceTemplates")
+        self.loads += 1
+        previous = self.catalogs.get(url)
+        # 工具没有变化时沿用旧版本号, 避免重新编译
+        if previous is not None and previous.tools == tools:
+            version = previous.version
+        else:
+            version = next(_versions)
+        catalog = Catalog(url, tools, prompts, resources, resource_templates, version)
+        self.catalogs[url] = catalog
+        return catalog
+
+    def stats(self) -> dict:
+        return {
+            "servers": {
+                url: {"version": catalog.version, "tools": len(catalog.tools), "stale": catalog.stale}
+                for url, catalog in self.catalogs.items()
+            },
+            "loads": self.loads,
+            "failures": self.failures,
+            "notifications": self.notifications,
+        }
+
+
+mcp_catalog = McpCatalog(mcp_pool)
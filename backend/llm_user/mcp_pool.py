@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import anyio
+import httpx
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+from mcp.shared.exceptions import McpError
+from mcp.types import ServerNotification
+
+# 每个 MCP 服务器保持一个长连接会话, 按 mcp_sse_url 复用
+MCP_CONNECT_TIMEOUT = float(os.getenv("MCP_CONNECT_TIMEOUT", "10"))
+MCP_REQUEST_TIMEOUT = float(os.getenv("MCP_REQUEST_TIMEOUT", "60"))
+# 单个会话上同时进行的请求数上限
+MCP_SESSION_CONCURRENCY = int(os.getenv("MCP_SESSION_CONCURRENCY", "8"))
+# 空闲超过这个时间的会话在复用前先 ping 一次
+MCP_HEALTH_CHECK_AFTER = float(os.getenv("MCP_HEALTH_CHECK_AFTER", "30"))
+# 空闲超过这个时间的会话被关闭
+MCP_IDLE_TIMEOUT = float(os.getenv("MCP_IDLE_TIMEOUT", "300"))
+
+# 请求超时时 mcp 返回的错误码, 说明连接可能已经断了
+REQUEST_TIMEOUT_CODE = 408
+# 说明连接已经断开的异常; 其它异常来自调用方或服务端业务, 不影响会话
+TRANSPORT_ERRORS = (
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    ConnectionError,
+    httpx.TransportError,
+)
+
+# 服务端通知的回调: (url, notification)
+NotificationListener = Callable[[str, Any], None]
+
+
+def _consume(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+
+class PooledSession:
+    """A long-lived ClientSession to one MCP server.
+
+    sse_client and ClientSession are anyio contexts that must be exited by the task
+    that entered them, so a dedicated owner task holds them open until shutdown.
+    """
+
+    def __init__(self, url: str, on_notification: Optional[NotificationListener] = None):
+        self.url = url
+        self.on_notification = on_notification
+        self.session: Optional[ClientSession] = None
+        self.semaphore = asyncio.Semaphore(MCP_SESSION_CONCURRENCY)
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.connects = 0
+        self.failures = 0
+        self.requests = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Event] = None
+
+    async def ensure_connected(self) -> ClientSession:
+        async with self._lock:
+            if self.session is not None and time.monotonic() - self.last_used > MCP_HEALTH_CHECK_AFTER:
+                try:
+                    await asyncio.wait_for(self.session.send_ping(), MCP_CONNECT_TIMEOUT)
+                except Exception as e:
+                    logging.warning(f"mcp session to {self.url} failed health check: {e!r}")
+                    await self.shutdown()
+            if self.session is None:
+                await self._connect()
+            return self.session
+
+    async def _connect(self):
+        ready = asyncio.get_running_loop().create_future()
+        ready.add_done_callback(_consume)
+        self._closing = asyncio.Event()
+        self._task = asyncio.create_task(self._own(ready, self._closing))
+        try:
+            self.session = await asyncio.wait_for(asyncio.shield(ready), MCP_CONNECT_TIMEOUT)
+        except BaseException:
+            self.failures += 1
+            await self.shutdown()
+            raise
+        self.connects += 1
+        logging.info(f"mcp session to {self.url} connected")
+
+    async def _own(self, ready: asyncio.Future, closing: asyncio.Event):
+        try:
+            async with sse_client(self.url, timeout=MCP_CONNECT_TIMEOUT) as streams:
+                async with ClientSession(
+                    *streams,
+                    read_timeout_seconds=timedelta(seconds=MCP_REQUEST_TIMEOUT),
+                    message_handler=self._handle_message,
+                ) as session:
+                    await session.initialize()
+                    ready.set_result(session)
+                    await closing.wait()
+        except Exception as e:
+            if ready.done():
+                logging.warning(f"mcp session to {self.url} closed: {e}")
+            else:
+                ready.set_exception(e)
+        finally:
+            if not ready.done():
+                ready.set_exception(ConnectionError(f"mcp session to {self.url} closed"))
+            if self._task is asyncio.current_task():
+                self.session = None
+
+    async def _handle_message(self, message):
+        if isinstance(message, ServerNotification) and self.on_notification is not None:
+            try:
+                self.on_notification(self.url, message.root)
+            except Exception:
+                logging.exception(f"mcp notification handler failed for {self.url}")
+
+    async def shutdown(self):
+        self.session = None
+        task, self._task = self._task, None
+        if task is None:
+            return
+        self._closing.set()
+        try:
+            await asyncio.wait_for(task, MCP_CONNECT_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logging.warning(f"mcp session to {self.url} failed to close: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "connected": self.session is not None,
+            "active": self.active,
+            "requests": self.requests,
+            "connects": self.connects,
+            "failures": self.failures,
+            "idle_seconds": time.monotonic() - self.last_used,
+        }
+
+
+class McpSessionPool:
+    """Pooled MCP sessions keyed by server URL.
+
+    Sessions connect on first use, are pinged before reuse after being idle, are
+    dropped after a transport failure (the next call reconnects) and are closed
+    after MCP_IDLE_TIMEOUT without requests.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, PooledSession] = {}
+        self.listeners: List[NotificationListener] = []
+        self._reaper: Optional[asyncio.Task] = None
+
+    def subscribe(self, listener: NotificationListener):
+        """Receive (url, notification) for server notifications on every pooled session."""
+        self.listeners.append(listener)
+
+    def _notify(self, url: str, notification):
+        for listener in self.listeners:
+            listener(url, notification)
+
+    @asynccontextmanager
+    async def session(self, url: str):
+        pooled = self.sessions.get(url)
+        if pooled is None:
+            pooled = self.sessions[url] = PooledSession(url, self._notify)
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+        async with pooled.semaphore:
+            pooled.active += 1
+            try:
+                session = await pooled.ensure_connected()
+                pooled.requests += 1
+                yield session
+            except McpError as e:
+                # 服务端返回的错误不影响会话, 超时则按断线处理
+                if e.error.code == REQUEST_TIMEOUT_CODE:
+                    pooled.failures += 1
+                    await pooled.shutdown()
+                raise
+            except TRANSPORT_ERRORS:
+                pooled.failures += 1
+                await pooled.shutdown()
+                raise
+            finally:
+                pooled.active -= 1
+                pooled.last_used = time.monotonic()
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(max(1.0, MCP_IDLE_TIMEOUT / 2))
+            now = time.monotonic()
+            for url, pooled in list(self.sessions.items()):
+                if pooled.active == 0 and now - pooled.last_used > MCP_IDLE_TIMEOUT:
+                    del self.sessions[url]
+                    await pooled.shutdown()
+                    logging.info(f"mcp session to {url} closed after idle")
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        sessions, self.sessions = list(self.sessions.values()), {}
+        await asyncio.gather(*[pooled.shutdown() for pooled in sessions], return_exceptions=True)
+
+    def stats(self) -> list:
+        return [pooled.stats() for pooled in self.sessions.values()]
+
+
+mcp_pool = McpSessionPool()
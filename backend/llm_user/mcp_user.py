@@ -1,5 +1,4 @@
 from typing import Dict, List, Optional
-from mcp import ClientSession
 from mcp.types import ResourceTemplate, Prompt, Resource, Tool
 from pydantic import BaseModel
 from backend.chat_room import room_chat
@@ -8,7 +7,9 @@ from backend.db.user import get_user_by_username, get_users_by_ids, get_users_by
 from backend.db.user import create_user
 from backend.model.model import User
 from backend.model.model import UserRole
-from mcp.client.sse import sse_client
+from backend.llm_user.mcp_catalog import Catalog, mcp_catalog
+from backend.llm_user.mcp_pool import mcp_pool
+from backend.llm_user.tool_cache import tool_result_cache
 
 
 class ServerInfo(BaseModel):
@@ -44,53 +45,45 @@ class McpUser:
             content, self.user_id, self.user_name, room_id
         )
     async def send_ping(self):
-        async with sse_client(self.sse_url) as client:
-            async with ClientSession(*client) as session:
-                await session.initialize()
-                await session.send_ping()
-    
+        async with mcp_pool.session(self.sse_url) as session:
+            await session.send_ping()
+
     async def execute_tool(self, tool_name: str, args: dict) -> None:
-        async with sse_client(self.sse_url) as client:
-            async with ClientSession(*client) as session:
-                await session.initialize()
-                result = await session.call_tool(tool_name, args)
-                return result
-        
+        # 配置为可缓存的工具走结果缓存, 相同的并发调用合并成一次
+        return await tool_result_cache.call(
+            self.user_name, self.sse_url, tool_name, args, lambda: self._call_tool(tool_name, args)
+        )
+
+    async def _call_tool(self, tool_name: str, args: dict):
+        async with mcp_pool.session(self.sse_url) as session:
+            return await session.call_tool(tool_name, args)
+
+    async def get_catalog(self) -> Catalog:
+        return await mcp_catalog.get(self.sse_url)
+
     async def list_tools(self) -> List[Tool]:
-        async with sse_client(self.sse_url) as client:
-            async with ClientSession(*client) as session:
-                await session.initialize()
-                tools = await session.list_tools()
-                return tools.tools
+        return (await self.get_catalog()).tools
 
     async def refresh_server_info(self) -> ServerInfo:
-        async with sse_client(self.sse_url) as client:
-            async with ClientSession(*client) as session:
-                await session.initialize()
-                self.tools=await session.list_tools().tools
-                self.prompts=await session.list_prompts().prompts
-                self.resources=await session.list_resources().resources
-                self.resource_templates=await session.list_resource_templates().resourceTemplates
-
+        mcp_catalog.invalidate(self.sse_url)
+        info = await self.get_server_info()
+        self.tools = info.tools
+        self.prompts = info.prompts
+        self.resources = info.resources
+        self.resource_templates = info.resource_templates
+        return info
 
     async def get_server_info(self) -> ServerInfo:
-        async with sse_client(self.sse_url) as client:
-            async with ClientSession(*client) as session:
-                await session.initialize()
-                tools=await session.list_tools()
-                prompts=await session.list_prompts()
-                resources=await session.list_resources()
-                resource_templates=await session.list_resource_templates()
-
-                return ServerInfo(
-                    name=self.user_name,
-                    url=self.sse_url,
-                    status="connected",
-                    tools=tools.tools,
-                    prompts=prompts.prompts,
-                    resources=resources.resources,
-                    resource_templates=resource_templates.resourceTemplates
-                )
+        catalog = await self.get_catalog()
+        return ServerInfo(
+            name=self.user_name,
+            url=self.sse_url,
+            status="connected",
+            tools=catalog.tools,
+            prompts=catalog.prompts,
+            resources=catalog.resources,
+            resource_templates=catalog.resource_templates
+        )
 
 
 async def create_mcp_user(user_name:str,sse_url:str):
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from mcp.types import CallToolResult, TextContent
+
+from backend.llm_user.mcp_user import McpUser
+
+# 单次工具调用的超时时间
+TOOL_CALL_TIMEOUT = float(os.getenv("MCP_TOOL_CALL_TIMEOUT", "30"))
+# 每个 MCP 服务器同时执行的工具调用数上限
+TOOL_SERVER_CONCURRENCY = int(os.getenv("MCP_TOOL_SERVER_CONCURRENCY", "4"))
+
+
+class ToolTask:
+    """One tool call requested by the LLM and, once run, its outcome."""
+
+    def __init__(self, name: str, arguments: str, mcp: Optional[McpUser]):
+        self.name = name
+        self.arguments = arguments
+        self.mcp = mcp
+        self.args: dict = {}
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.elapsed = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_message(self) -> dict:
+        message = {
+            "mcp_id": self.mcp.user_name if self.mcp else None,
+            "func_name": self.name,
+            "args": self.args,
+        }
+        if self.ok:
+            message["result"] = self.result
+        else:
+            message["error"] = self.error
+        return message
+
+
+def render_result(result: CallToolResult) -> str:
+    parts = []
+    for content in result.content:
+        if isinstance(content, TextContent):
+            parts.append(content.text)
+        else:
+            parts.append(f"[{content.type}]")
+    return "\n".join(parts)
+
+
+class ToolExecutor:
+    """Runs the tool calls of one LLM reply concurrently.
+
+    Calls to the same MCP server share a per-server limit. Each call has its own
+    timeout, which also covers the wait for that limit. Failures are reported per
+    call and results come back in call order. Cancelling `run` cancels every call still in flight.
+    """
+
+    def __init__(self, per_server: int = TOOL_SERVER_CONCURRENCY, timeout: float = TOOL_CALL_TIMEOUT):
+        self.per_server = per_server
+        self.timeout = timeout
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def _limit(self, server: str) -> asyncio.Semaphore:
+        limit = self._limits.get(server)
+        if limit is None:
+            limit = self._limits[server] = asyncio.Semaphore(self.per_server)
+        return limit
+
+    async def run(self, tasks: List[ToolTask]) -> List[ToolTask]:
+        await asyncio.gather(*[self._run_one(task) for task in tasks])
+        return tasks
+
+    async def _run_one(self, task: ToolTask):
+        self.calls += 1
+        try:
+            task.args = json.loads(task.arguments) if task.arguments else {}
+        except json.JSONDecodeError as e:
+            task.error = f"invalid arguments: {e}"
+        if task.mcp is None:
+            task.error = f"unknown tool: {task.name}"
+        if task.error is not None:
+            self.failures += 1
+            return
+        started = time.perf_counter()
+        try:
+            # 超时从排队等待服务器并发名额时就开始计算
+            result = await asyncio.wait_for(self._call(task), self.timeout)
+            if result.isError:
+                task.error = render_result(result)
+            else:
+                task.result = render_result(result)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            task.error = f"timed out after {self.timeout:g}s"
+        except Exception as e:
+            logging.warning(f"tool {task.name} on {task.mcp.user_name} failed: {e!r}")
+            task.error = str(e) or repr(e)
+        finally:
+            task.elapsed = time.perf_counter() - started
+        if task.error is not None:
+            self.failures += 1
+
+    async def _call(self, task: ToolTask) -> CallToolResult:
+        async with self._limit(task.mcp.sse_url):
+            return await task.mcp.execute_tool(task.name, task.args)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "per_server": self.per_server,
+            "timeout": self.timeout,
+        }
+
+
+tool_executor = ToolExecutor()
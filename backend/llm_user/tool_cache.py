@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from mcp.types import CallToolResult
+
+from backend.cache import AsyncCache
+
+# 可缓存的工具及缓存秒数, 例如 "GetWeather=60,twitter:search_user_by_name=300"
+# 不带服务器名时对所有服务器上的同名工具生效; 未列出的工具每次都真实调用
+MCP_TOOL_CACHE = os.getenv("MCP_TOOL_CACHE", "")
+MCP_TOOL_CACHE_SIZE = int(os.getenv("MCP_TOOL_CACHE_SIZE", "1024"))
+
+
+def parse_tool_ttls(spec: str) -> Dict[str, float]:
+    ttls = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, ttl = entry.rpartition("=")
+        try:
+            if not name.strip():
+                raise ValueError(entry)
+            ttls[name.strip()] = float(ttl)
+        except ValueError:
+            logging.warning(f"ignoring invalid MCP_TOOL_CACHE entry: {entry}")
+    return ttls
+
+
+def canonical_args(args: dict) -> str:
+    return json.dumps(args, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+class ToolResultCache:
+    """Result cache and singleflight for tools marked idempotent in MCP_TOOL_CACHE.
+
+    Entries are keyed by (server url, tool, canonical args). Concurrent identical
+    calls share one upstream request; a caller that times out or is cancelled does
+    not cancel it for the others. Error results are shared but not cached.
+    """
+
+    def __init__(self, ttls: Dict[str, float], maxsize: int = MCP_TOOL_CACHE_SIZE):
+        self.ttls = ttls
+        self.cache = AsyncCache("mcp_tools", maxsize=maxsize, ttl=max(ttls.values(), default=0))
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+
+    def ttl(self, server: str, tool_name: str) -> Optional[float]:
+        return self.ttls.get(f"{server}:{tool_name}", self.ttls.get(tool_name))
+
+    async def call(
+        self, server: str, url: str, tool_name: str, args: dict, call: Callable[[], Awaitable[CallToolResult]]
+    ) -> CallToolResult:
+        ttl = self.ttl(server, tool_name)
+        if not ttl or ttl <= 0:
+            return await call()
+        key = (url, tool_name, canonical_args(args))
+        found, result = self.cache.get(key)
+        if found:
+            return result
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.create_task(call())
+            task.add_done_callback(lambda done: self._done(key, ttl, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, ttl: float, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if not result.isError:
+            self.cache.set(key, result, ttl)
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats["coalesced"] = self.coalesced
+        stats["inflight"] = len(self._inflight)
+        stats["tools"] = self.ttls
+        return stats
+
+
+tool_result_cache = ToolResultCache(parse_tool_ttls(MCP_TOOL_CACHE))
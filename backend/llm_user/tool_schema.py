@@ -0,0 +1,132 @@
+import copy
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from mcp import Tool
+
+from backend.llm_user.mcp_catalog import Catalog
+
+# 合并后的工具集合缓存上限 (按房间里 MCP 服务器及其目录版本的组合)
+TOOLSET_CACHE_SIZE = 256
+# 展开 $ref 的最大深度, 防止递归模型无限展开
+MAX_REF_DEPTH = 8
+
+# 值是子 schema 的关键字
+_SCHEMA_KEYS = ("items", "additionalProperties", "not", "contains", "if", "then", "else")
+# 值是子 schema 列表的关键字
+_SCHEMA_LIST_KEYS = ("anyOf", "oneOf", "allOf", "prefixItems")
+# 值是 名字 -> 子 schema 的关键字
+_SCHEMA_MAP_KEYS = ("properties", "patternProperties")
+
+
+def _resolve(ref: str, defs: dict) -> dict:
+    for prefix in ("#/$defs/", "#/definitions/"):
+        if ref.startswith(prefix) and ref[len(prefix):] in defs:
+            return defs[ref[len(prefix):]]
+    raise ValueError(f"unresolvable schema reference: {ref}")
+
+
+def compile_schema(schema, defs: dict, depth: int = 0):
+    """Inline local $refs and turn pydantic titles into descriptions, keeping everything else."""
+    if not isinstance(schema, dict):
+        return schema
+    if "$ref" in schema:
+        if depth >= MAX_REF_DEPTH:
+            return {"type": "object"}
+        target = compile_schema(_resolve(schema["$ref"], defs), defs, depth + 1)
+        siblings = {key: value for key, value in schema.items() if key != "$ref"}
+        return {**target, **compile_schema(siblings, defs, depth)}
+    compiled = {}
+    for key, value in schema.items():
+        if key in ("$defs", "definitions", "title"):
+            continue
+        if key in _SCHEMA_KEYS:
+            compiled[key] = compile_schema(value, defs, depth)
+        elif key in _SCHEMA_LIST_KEYS:
+            compiled[key] = [compile_schema(item, defs, depth) for item in value]
+        elif key in _SCHEMA_MAP_KEYS:
+            compiled[key] = {name: compile_schema(item, defs, depth) for name, item in value.items()}
+        else:
+            compiled[key] = copy.deepcopy(value)
+    # 没有 description 时用 title 作为参数说明
+    if "description" not in compiled and isinstance(schema.get("title"), str):
+        compiled["description"] = schema["title"]
+    return compiled
+
+
+def compile_tool(tool: Tool) -> dict:
+    """OpenAI function spec for an MCP tool, with the full inputSchema as parameters."""
+    schema = tool.inputSchema or {}
+    defs = {**schema.get("definitions", {}), **schema.get("$defs", {})}
+    parameters = compile_schema(schema, defs)
+    # 工具级别的 title 是 pydantic 生成的参数模型名, 不作为说明
+    if "description" in parameters and "description" not in schema:
+        del parameters["description"]
+    parameters["type"] = "object"
+    parameters.setdefault("properties", {})
+    parameters["required"] = list(parameters.get("required", []))
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description or "",
+            "parameters": parameters,
+        },
+    }
+
+
+class Toolset:
+    """Function specs ready to send to the LLM plus the tool name -> server routing table."""
+
+    def __init__(self, specs: List[dict], tool2mcp: Dict[str, str]):
+        self.specs = specs
+        self.tool2mcp = tool2mcp
+
+
+class ToolSchemaRegistry:
+    """Compiles each server's tools once per catalog version."""
+
+    def __init__(self):
+        # url -> (version, 编译后的工具描述)
+        self._compiled: Dict[str, Tuple[int, List[dict]]] = {}
+        self._toolsets: "OrderedDict[tuple, Toolset]" = OrderedDict()
+        self.compiles = 0
+
+    def specs(self, catalog: Catalog) -> List[dict]:
+        compiled = self._compiled.get(catalog.url)
+        if compiled is None or compiled[0] != catalog.version:
+            specs = []
+            for tool in catalog.tools:
+                try:
+                    specs.append(compile_tool(tool))
+                except ValueError as e:
+                    logging.warning(f"skip mcp tool {tool.name} of {catalog.url}: {e}")
+            compiled = self._compiled[catalog.url] = (catalog.version, specs)
+            self.compiles += 1
+        return compiled[1]
+
+    def toolset(self, servers: List[Tuple[str, Catalog]]) -> Toolset:
+        """Merge the tools of (server name, catalog) pairs; the first server wins a name clash."""
+        key = tuple((name, catalog.url, catalog.version) for name, catalog in servers)
+        toolset = self._toolsets.get(key)
+        if toolset is not None:
+            self._toolsets.move_to_end(key)
+            return toolset
+        specs = []
+        tool2mcp = {}
+        for name, catalog in servers:
+            for spec in self.specs(catalog):
+                tool_name = spec["function"]["name"]
+                if tool_name in tool2mcp:
+                    logging.warning(f"mcp tool {tool_name} of {name} shadowed by {tool2mcp[tool_name]}")
+                    continue
+                tool2mcp[tool_name] = name
+                specs.append(spec)
+        toolset = self._toolsets[key] = Toolset(specs, tool2mcp)
+        while len(self._toolsets) > TOOLSET_CACHE_SIZE:
+            self._toolsets.popitem(last=False)
+        return toolset
+
+
+tool_schema_registry = ToolSchemaRegistry()
@@ -16,8 +16,15 @@ from openai import OpenAI
 
 from dotenv import load_dotenv
 
+from backend.chat_room.room_chat import chat_room_manager
+from backend.db.chat_room import message_writer, register_room_invalidation
+from backend.db.indexes import init_indexes
+from backend.db.password import PasswordHasherBusy, password_hasher
+from backend.search.index import search_index
 from backend.llm_user.llm_user import init_llm_user
-from backend.routes import auth, chat, mcp
+from backend.llm_user.mcp_pool import mcp_pool
+from backend.routes import auth, chat, mcp, metrics, ws
+from backend.routes.util import register_token_revocation
 
 load_dotenv()
 
@@ -49,6 +56,17 @@ async def error_handling_middleware(request: Request, call_next):
         )
 
 
+# 密码哈希队列已满时让客户端稍后重试
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    logger.warning(f"Password hasher busy: {exc}")
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server is busy, please retry later"},
+        headers={"Retry-After": "1"},
+    )
+
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -63,16 +81,33 @@ app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 
 # Include the chat router
 app.include_router(chat.router, prefix="/api/chat_room", tags=["chat"])
+app.include_router(ws.router, prefix="/api/chat_room", tags=["chat"])
 
 
 app.include_router(mcp.router, prefix="/api/mcp", tags=["mcp"])
 
+app.include_router(metrics.router, prefix="/api/metrics", tags=["metrics"])
+
 
 @app.on_event("startup")
 async def startup_event():
+    await init_indexes()
+    register_token_revocation()
+    register_room_invalidation(chat_room_manager.broker)
+    await chat_room_manager.start()
+    await search_index.start()
     init_llm_user()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await chat_room_manager.close()
+    await message_writer.close()
+    await search_index.close()
+    password_hasher.close()
+    await mcp_pool.close()
+
+
 if __name__ == "__main__":
 
     import uvicorn
@@ -18,6 +18,7 @@ class ChatRoom(MongoBaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     participants: List[str] = Field(default_factory=list)
     participant_users: Dict[str, str] = Field(default_factory=dict)
+    last_message: Optional[Message] = None
     is_public: bool = True
 
 
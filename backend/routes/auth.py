@@ -7,9 +7,8 @@ from backend.db.user import (
     get_user_by_email,
     create_user,
     verify_password,
-    delete_token,
 )
-from backend.routes.util import get_current_user, create_access_token
+from backend.routes.util import get_current_user, create_access_token, revoke_token
 from backend.model.model import User, Token
 
 
@@ -51,7 +50,7 @@ async def register(user: User):
 async def login(user_data: UserLogin):
     # Get user from database
     user = await get_user_by_username(user_data.username)
-    if not user or not verify_password(user_data.password, user["password"]):
+    if not user or not await verify_password(user_data.password, user["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -77,5 +76,5 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 @router.post("/logout")
 async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
-    await delete_token(token)
+    await revoke_token(token)
     return {"message": "Successfully logged out"}
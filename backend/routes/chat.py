@@ -1,74 +1,74 @@
-import bson
+import asyncio
+
 from fastapi import (
     APIRouter,
     Depends,
     HTTPException,
     Request,
 )
-from backend.chat_room.room_chat import chat_room_manager as room_chat
+from backend.chat_room.room_chat import (
+    HEARTBEAT_FRAME,
+    SSE_BATCH_WINDOW,
+    SSE_HEARTBEAT,
+    SubscriberClosed,
+    chat_room_manager as room_chat,
+    dumps,
+)
 from backend.db.user import get_users_by_ids, search_user, get_user_by_username
 from backend.routes.util import get_current_user
 from backend.db.chat_room import (
-    get_room_messages,
+    iter_room_messages,
+    message_cursor,
     create_chat_room,
     get_chat_room,
     add_participant_to_room,
     get_chat_rooms,
+    get_latest_messages,
+    is_room_participant,
 )
+from backend.search.index import search_index
 
 
-from typing import List
-import json
-from datetime import datetime
+from typing import List, Optional
 from pydantic import BaseModel
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
+from fastapi.responses import StreamingResponse
 from sse_starlette.sse import EventSourceResponse
-from backend.model.model import ChatRoom, Message
+from backend.model.model import ChatRoom
 
 
 class InviteRequest(BaseModel):
     username: str
 
 
-# Database setup
-MONGODB_URL = os.getenv("MONGODB_URI")
-client = AsyncIOMotorClient(MONGODB_URL)
-db = client.chat_db
-messages_collection = db.messages
-chat_rooms_collection = db.chat_rooms
-
-
-# Database functions
-async def save_message(
-    content: str, sender_id: str, sender_username: str, room_id: str
-):
-    message = {
-        "content": content,
-        "sender_id": sender_id,
-        "sender_username": sender_username,
-        "room_id": room_id,
-        "created_at": datetime.utcnow(),
-    }
-    result = await messages_collection.insert_one(message)
-    message["id"] = str(result.inserted_id)
-    return message
-
-
-async def get_chat_room(room_id: str):
-    ret = await chat_rooms_collection.find_one({"_id": bson.ObjectId(room_id)})
-
-    return ret
-
-
 # Routes
 router = APIRouter()
 
 
 @router.get("/room_list", response_model=List[ChatRoom])
-async def get_rooms(current_user: dict = Depends(get_current_user)):
-    ret = await get_chat_rooms(str(current_user["_id"]))
-    return ret
+async def get_rooms(
+    limit: int = 100, before: Optional[str] = None, current_user: dict = Depends(get_current_user)
+):
+    """Rooms with participant names and the latest message, newest room first.
+
+    Pass the id of the last room as `before` to fetch the next page.
+    """
+    try:
+        rooms = await get_chat_rooms(str(current_user["_id"]), limit, before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # 整页房间的成员一次批量查询, 最新消息一次聚合
+    participant_ids = {user_id for room in rooms for user_id in room["participants"]}
+    users, latest = await asyncio.gather(
+        get_users_by_ids(list(participant_ids)),
+        get_latest_messages([room["id"] for room in rooms]),
+    )
+    usernames = {str(user["_id"]): user["username"] for user in users}
+    for room in rooms:
+        room["participant_users"] = {
+            user_id: usernames[user_id] for user_id in room["participants"] if user_id in usernames
+        }
+        room["last_message"] = latest.get(room["id"])
+    return rooms
 
 
 @router.post("/create_room", response_model=ChatRoom)
@@ -86,12 +86,53 @@ async def get_room_info(room_id: str, current_user: dict = Depends(get_current_u
     return room
 
 
-@router.get("/room_messages/{room_id}", response_model=List[Message])
-async def get_messages(room_id: str, current_user: dict = Depends(get_current_user)):
+# 默认返回的消息字段, 与 Message 模型一致
+HISTORY_FIELDS = ["content", "sender_id", "sender_username", "created_at"]
+HISTORY_CHUNK = 50
 
-    messages = await get_room_messages(room_id)
 
-    return messages
+def encode_history_message(message: dict) -> bytes:
+    item = {key: value for key, value in message.items() if key != "_id"}
+    item["id"] = str(message["_id"])
+    item["created_at"] = message["created_at"].isoformat()
+    item["cursor"] = message_cursor(message)
+    return dumps(item)
+
+
+@router.get("/room_messages/{room_id}")
+async def get_messages(
+    room_id: str,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """Page of room history as a JSON array, streamed as the store yields it.
+
+    Every item has a `cursor`; pass the last one as `before` (or `after`) to page further.
+    """
+    try:
+        messages = iter_room_messages(
+            room_id, limit, before, after, fields.split(",") if fields else HISTORY_FIELDS
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def stream():
+        yield b"["
+        chunk = []
+        first = True
+        async for message in messages:
+            chunk.append(encode_history_message(message))
+            if len(chunk) == HISTORY_CHUNK:
+                yield (b"" if first else b",") + b",".join(chunk)
+                chunk, first = [], False
+        if chunk:
+            yield (b"" if first else b",") + b",".join(chunk)
+        yield b"]"
+
+    return StreamingResponse(stream(), media_type="application/json")
 
 
 @router.post("/room_messages/{room_id}")
@@ -112,20 +153,74 @@ async def send_message(
 async def sse_endpoint(
     request: Request, room_id: str, current_user: dict = Depends(get_current_user)
 ):
+    # 浏览器自动重连时带 Last-Event-ID 头; 前端手动重连时用 last_event_id 参数
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+
     async def event_generator():
-        queue = await room_chat.enter_room(current_user["_id"], room_id)
+        queue = await room_chat.enter_room(str(current_user["_id"]), room_id, last_event_id)
         try:
             while True:
                 if await request.is_disconnected():
                     break
-                message = await queue.get()
-                yield {"event": "message", "data": json.dumps(message)}
+                frame = await queue.get()
+                yield frame.sse
+        except SubscriberClosed:
+            pass
+        finally:
+            room_chat.disconnect(room_id, queue)
+
+    async def batched_event_generator():
+        # 一次写出窗口内的所有事件; 断线由 StreamingResponse 监听, 不再逐条检查
+        queue = await room_chat.enter_room(str(current_user["_id"]), room_id, last_event_id)
+        try:
+            while True:
+                frames = await queue.get_batch(SSE_BATCH_WINDOW, SSE_HEARTBEAT)
+                if not frames:
+                    if await request.is_disconnected():
+                        break
+                    yield HEARTBEAT_FRAME
+                    continue
+                yield b"".join(frame.sse for frame in frames)
+        except SubscriberClosed:
+            pass
         finally:
-            room_chat.disconnect(current_user["_id"], room_id)
+            room_chat.disconnect(room_id, queue)
 
+    if SSE_BATCH_WINDOW > 0:
+        return StreamingResponse(
+            batched_event_generator(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     return EventSourceResponse(event_generator())
 
 
+@router.get("/room_stats/{room_id}")
+async def get_room_stats(room_id: str, current_user: dict = Depends(get_current_user)):
+    stats = room_chat.room_stats(room_id)
+    if stats is None:
+        return {"room_id": room_id, "connections": 0, "total_depth": 0, "max_depth": 0, "dropped": 0, "subscribers": []}
+    return stats
+
+
+@router.get("/search/{room_id}")
+async def search_messages(
+    room_id: str,
+    q: str,
+    offset: int = 0,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user),
+):
+    if not search_index.enabled:
+        raise HTTPException(status_code=503, detail="Search is disabled")
+    if not await is_room_participant(room_id, str(current_user["_id"])):
+        raise HTTPException(status_code=403, detail="You are not a participant of this room")
+    try:
+        return await search_index.search(room_id, q, offset, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.get("/user/search")
 async def search_user(username: str, current_user: dict = Depends(get_current_user)):
     return await search_user(username, str(current_user["_id"]))
@@ -0,0 +1,58 @@
+from fastapi import APIRouter, Depends
+
+from backend.db.chat_room import room_cache
+from backend.db.conn import pool_metrics
+from backend.db.password import password_hasher
+from backend.db.user import user_cache
+from backend.llm_user.mcp_catalog import mcp_catalog
+from backend.llm_user.mcp_pool import mcp_pool
+from backend.llm_user.task_exec import tool_executor
+from backend.llm_user.tool_cache import tool_result_cache
+from backend.routes.util import get_current_user, token_cache
+
+router = APIRouter()
+
+
+@router.get("/user_cache")
+async def get_user_cache_stats(current_user: dict = Depends(get_current_user)):
+    return user_cache.stats()
+
+
+@router.get("/room_cache")
+async def get_room_cache_stats(current_user: dict = Depends(get_current_user)):
+    return room_cache.stats()
+
+
+@router.get("/mongo_pool")
+async def get_mongo_pool_stats(current_user: dict = Depends(get_current_user)):
+    return pool_metrics.stats()
+
+
+@router.get("/token_cache")
+async def get_token_cache_stats(current_user: dict = Depends(get_current_user)):
+    return token_cache.stats()
+
+
+@router.get("/password_hasher")
+async def get_password_hasher_stats(current_user: dict = Depends(get_current_user)):
+    return password_hasher.stats()
+
+
+@router.get("/mcp_pool")
+async def get_mcp_pool_stats(current_user: dict = Depends(get_current_user)):
+    return mcp_pool.stats()
+
+
+@router.get("/mcp_catalog")
+async def get_mcp_catalog_stats(current_user: dict = Depends(get_current_user)):
+    return mcp_catalog.stats()
+
+
+@router.get("/tool_executor")
+async def get_tool_executor_stats(current_user: dict = Depends(get_current_user)):
+    return tool_executor.stats()
+
+
+@router.get("/tool_cache")
+async def get_tool_cache_stats(current_user: dict = Depends(get_current_user)):
+    return tool_result_cache.stats()
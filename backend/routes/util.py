@@ -1,15 +1,52 @@
 import asyncio
+import copy
 from datetime import datetime, timedelta
 from typing import Optional
 import os
+import time
 import jwt
 from fastapi import HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
-from backend.db.user import get_user_by_username, get_token,save_token
+from backend.cache import AsyncCache
+from backend.chat_room.room_chat import chat_room_manager
+from backend.db.user import get_user_by_username, get_token, save_token, delete_token
 # JWT配置
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
 
+# 已验证 token 的缓存: token -> TokenEntry, 有效期不超过 token 自身的 exp; 校验失败不缓存
+token_cache = AsyncCache(
+    "tokens",
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL", "300")),
+    negative_ttl=0,
+)
+# 缓存的 token 超过这个秒数后重新到 tokens 集合确认未被吊销, 限制 broker 通知丢失时的影响
+TOKEN_RECHECK_SECONDS = float(os.getenv("TOKEN_RECHECK_SECONDS", "30"))
+# 吊销 token 时通过 chat broker 通知所有 worker 清掉缓存
+REVOKE_TOPIC = "auth.revoke"
+
+
+class TokenEntry:
+    """A verified token: the user snapshot, the token's exp and when Mongo last confirmed it."""
+
+    __slots__ = ("user", "expires", "checked_at")
+
+    def __init__(self, user: dict, expires: float):
+        self.user = user
+        self.expires = expires
+        self.checked_at = time.monotonic()
+
+
+def _on_broker_message(topic: str, payload: bytes):
+    if topic == REVOKE_TOPIC:
+        token_cache.invalidate(payload.decode())
+
+
+def register_token_revocation():
+    """Drop tokens revoked by other workers from this worker's cache; called on startup."""
+    chat_room_manager.broker.subscribe(_on_broker_message)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -43,23 +80,48 @@ async def get_token_from_request(request: Request) -> Optional[str]:
 # 获取当前用户
 async def get_current_user(request: Request):
     token = await get_token_from_request(request)
+    return await get_user_by_token(token)
+
+
+async def get_user_by_token(token: Optional[str]):
     if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Not authenticated",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # 命中缓存时不再校验签名, 只定期确认 token 仍在数据库中
+    entry = await token_cache.get_or_load(token, lambda: _verify_token(token), ttl=_token_ttl)
+    if time.monotonic() - entry.checked_at > TOKEN_RECHECK_SECONDS:
+        await _recheck_token(token, entry)
+    # 调用方会修改返回的文档, 返回副本
+    return copy.copy(entry.user)
+
+
+def _token_ttl(entry: TokenEntry) -> float:
+    return min(token_cache.ttl, entry.expires - time.time())
 
+
+async def _recheck_token(token: str, entry: TokenEntry):
+    # 先更新时间, 同一个 token 的并发请求只查一次
+    checked_at, entry.checked_at = entry.checked_at, time.monotonic()
     try:
-        # Check if token exists in MongoDB
         token_data = await get_token(token)
-        if not token_data:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token is invalid or expired",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
+    except Exception:
+        entry.checked_at = checked_at
+        raise
+    if not token_data:
+        token_cache.invalidate(token)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token is invalid or expired",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
 
+async def _verify_token(token: str) -> TokenEntry:
+    """Check the signature and the tokens collection."""
+    try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
@@ -68,6 +130,14 @@ async def get_current_user(request: Request):
                 detail="Could not validate credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        # Check if token exists in MongoDB
+        token_data = await get_token(token)
+        if not token_data:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token is invalid or expired",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
     except (jwt.PyJWTError, HTTPException) as e:
         print("error",e)
         raise HTTPException(
@@ -82,4 +152,11 @@ async def get_current_user(request: Request):
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return user
+    return TokenEntry(user, payload.get("exp", time.time() + token_cache.ttl))
+
+
+async def revoke_token(token: str):
+    """Delete a token and drop it from the token cache of every worker."""
+    await delete_token(token)
+    token_cache.invalidate(token)
+    await chat_room_manager.broker.publish(REVOKE_TOPIC, token.encode())
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+
+from backend.chat_room.room_chat import (
+    SSE_HEARTBEAT,
+    SubscriberClosed,
+    SubscriberQueue,
+    chat_room_manager as room_chat,
+    msgpack,
+)
+from backend.routes.util import get_user_by_token
+
+router = APIRouter()
+
+# 单个 WebSocket 上最多同时订阅的房间数
+WS_MAX_ROOMS = int(os.getenv("CHAT_WS_MAX_ROOMS", "50"))
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+
+class RoomSocket:
+    """One authenticated WebSocket multiplexing several room subscriptions.
+
+    Client frames are objects with an `op`: subscribe, unsubscribe, send or ping.
+    Room events are forwarded with the same payload as the SSE stream.
+    """
+
+    def __init__(self, websocket: WebSocket, user: dict, encoding: str):
+        self.websocket = websocket
+        self.user = user
+        self.user_id = str(user["_id"])
+        self.encoding = encoding
+        self.subscriptions: Dict[str, SubscriberQueue] = {}
+        self.pumps: Dict[str, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, message: dict):
+        if self.encoding == ENCODING_MSGPACK:
+            data = {"type": "websocket.send", "bytes": msgpack.packb(message)}
+        else:
+            data = {"type": "websocket.send", "text": json.dumps(message, ensure_ascii=False)}
+        async with self._send_lock:
+            await self.websocket.send(data)
+
+    async def receive(self) -> dict:
+        data = await self.websocket.receive()
+        if data["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(data.get("code", 1000))
+        if data.get("bytes") is not None:
+            if self.encoding != ENCODING_MSGPACK:
+                raise ValueError("binary frames require encoding=msgpack")
+            request = msgpack.unpackb(data["bytes"])
+        else:
+            request = json.loads(data["text"])
+        if not isinstance(request, dict):
+            raise ValueError("request must be an object")
+        return request
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    request = await self.receive()
+                except ValueError as e:
+                    await self.send({"type": "error", "ref": None, "detail": str(e)})
+                    continue
+                await self.dispatch(request)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for room_id in list(self.subscriptions):
+                self.unsubscribe(room_id)
+
+    async def dispatch(self, request: dict):
+        # 单个请求失败只回复错误, 不断开连接和其它房间的订阅
+        try:
+            await self.handle(request)
+            return
+        except HTTPException as e:
+            detail = e.detail
+        except (KeyError, ValueError) as e:
+            detail = str(e)
+        except WebSocketDisconnect:
+            raise
+        except Exception:
+            logging.exception(f"websocket request {request.get('op')} of user {self.user_id} failed")
+            detail = "internal error"
+        await self.send({"type": "error", "ref": request.get("ref"), "detail": detail})
+
+    async def handle(self, request: dict):
+        op = request["op"]
+        if op == "subscribe":
+            await self.subscribe(request["room_id"], request.get("last_event_id"))
+        elif op == "unsubscribe":
+            self.unsubscribe(request["room_id"])
+        elif op == "send":
+            message = await room_chat.send_message(
+                request["content"],
+                self.user_id,
+                self.user["username"],
+                request["room_id"],
+                request.get("mentions", []),
+            )
+            await self.send({"type": "ack", "ref": request.get("ref"), "id": str(message["_id"])})
+            return
+        elif op == "ping":
+            await self.send({"type": "pong", "ref": request.get("ref")})
+            return
+        else:
+            raise ValueError(f"unknown op: {op}")
+        await self.send({"type": "ack", "ref": request.get("ref")})
+
+    async def subscribe(self, room_id: str, last_event_id=None):
+        if room_id in self.subscriptions:
+            return
+        if len(self.subscriptions) >= WS_MAX_ROOMS:
+            raise ValueError("too many rooms on one socket")
+        queue = await room_chat.enter_room(self.user_id, room_id, last_event_id)
+        self.subscriptions[room_id] = queue
+        self.pumps[room_id] = asyncio.create_task(self.pump(room_id, queue))
+
+    def unsubscribe(self, room_id: str):
+        queue = self.subscriptions.pop(room_id, None)
+        if queue is None:
+            return
+        self.pumps.pop(room_id).cancel()
+        room_chat.disconnect(room_id, queue)
+
+    async def pump(self, room_id: str, queue: SubscriberQueue):
+        key = "bytes" if self.encoding == ENCODING_MSGPACK else "text"
+        try:
+            while True:
+                frames = await queue.get_batch(0, SSE_HEARTBEAT)
+                async with self._send_lock:
+                    if not frames:
+                        await self.websocket.send({"type": "websocket.send", key: self._heartbeat()})
+                    for frame in frames:
+                        data = frame.msgpack if key == "bytes" else frame.text
+                        await self.websocket.send({"type": "websocket.send", key: data})
+        except SubscriberClosed:
+            # 慢消费者被断开, 通知客户端重新订阅
+            await self.send({"type": "resync", "data": {"room_id": room_id}})
+            self.subscriptions.pop(room_id, None)
+            self.pumps.pop(room_id, None)
+            room_chat.disconnect(room_id, queue)
+        except Exception as e:
+            logging.info(f"websocket pump for room {room_id} stopped: {e}")
+
+    def _heartbeat(self):
+        if self.encoding == ENCODING_MSGPACK:
+            return msgpack.packb({"type": "ping"})
+        return '{"type":"ping"}'
+
+
+@router.websocket("/ws")
+async def room_socket(websocket: WebSocket):
+    encoding = websocket.query_params.get("encoding", ENCODING_JSON)
+    await websocket.accept()
+    if encoding not in (ENCODING_JSON, ENCODING_MSGPACK) or (encoding == ENCODING_MSGPACK and msgpack is None):
+        await websocket.close(code=1003, reason=f"unsupported encoding: {encoding}")
+        return
+    try:
+        user = await get_user_by_token(websocket.query_params.get("token"))
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await RoomSocket(websocket, user, encoding).run()
@@ -0,0 +1,487 @@
+import asyncio
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import suppress
+from itertools import chain
+from typing import Dict, Iterable, List, Optional
+
+# 房间消息的本地全文索引: 每个房间一个目录, 倒排表分段写入文件并通过 mmap 读取
+SEARCH_ENABLED = os.getenv("CHAT_SEARCH", "true").lower() in ("1", "true", "yes")
+SEARCH_INDEX_DIR = os.getenv("CHAT_SEARCH_INDEX_DIR", "data/search_index")
+# 内存中积累多少条消息后写成一个新的段
+FLUSH_DOCS = int(os.getenv("CHAT_SEARCH_FLUSH_DOCS", "500"))
+# 不足 FLUSH_DOCS 的缓冲也按这个间隔写盘, 限制崩溃时丢失的消息, 写完的房间才能被关闭
+FLUSH_INTERVAL = float(os.getenv("CHAT_SEARCH_FLUSH_INTERVAL_S", "30"))
+# 同时打开(mmap)的房间索引数
+OPEN_ROOMS = int(os.getenv("CHAT_SEARCH_OPEN_ROOMS", "128"))
+# 一个房间的段数超过这个值时合并成一个段, 限制每次查询要读的段数
+MAX_SEGMENTS = int(os.getenv("CHAT_SEARCH_MAX_SEGMENTS", "16"))
+PAGE_MAX = 100
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+# 中日韩文字按二元组切分, 其它按单词切分
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class Segment:
+    """An immutable on-disk slice of a room index.
+
+    `<name>.post` holds (doc_no, tf) uint32 pairs grouped by term, `<name>.terms` maps each
+    term to its (offset, count) in that file.
+    """
+
+    def __init__(self, path: str, name: str):
+        self.name = name
+        with open(os.path.join(path, name + ".terms"), encoding="utf-8") as f:
+            self.terms: Dict[str, List[int]] = json.load(f)
+        self._file = open(os.path.join(path, name + ".post"), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._postings = memoryview(self._mmap).cast("I") if self._mmap else memoryview(array("I"))
+
+    def postings(self, term: str):
+        entry = self.terms.get(term)
+        if entry is None:
+            return ()
+        offset, count = entry
+        view = self._postings[offset * 2:(offset + count) * 2]
+        return zip(view[0::2], view[1::2])
+
+    @property
+    def size(self) -> int:
+        return len(self._postings) // 2
+
+    def close(self):
+        self._postings.release()
+        if self._mmap:
+            self._mmap.close()
+        self._file.close()
+
+    @staticmethod
+    def write(path: str, name: str, postings: Dict[str, Iterable[tuple]]):
+        terms = {}
+        data = array("I")
+        for term, entries in postings.items():
+            offset = len(data) // 2
+            for doc_no, tf in entries:
+                data.append(doc_no)
+                data.append(tf)
+            terms[term] = [offset, len(data) // 2 - offset]
+        with open(os.path.join(path, name + ".post"), "wb") as f:
+            data.tofile(f)
+        # 词典最后写, 它的存在表示这个段已经完整
+        tmp = os.path.join(path, name + ".terms.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, name + ".terms"))
+
+
+class RoomIndex:
+    """Inverted index of one room: flushed segments plus an in-memory buffer.
+
+    Documents are numbered in insertion order. `docs.jsonl` stores them and `docs.idx`
+    their byte offsets and token counts, so results are returned without Mongo.
+    `meta.json` is written last by every flush and lists what is committed; anything
+    a crash left behind past it is discarded on open.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = {"docs": 0, "doc_bytes": 0, "segments": []}
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        self._discard_uncommitted(meta)
+        self.segments = [Segment(path, name) for name in meta["segments"]]
+        self._idx = array("Q")
+        with open(os.path.join(path, "docs.idx"), "rb") as f:
+            self._idx.frombytes(f.read())
+        self.doc_bytes = meta["doc_bytes"]
+        self.total_length = sum(self._idx[1::2])
+        self._docs = None
+        self._map_docs()
+        self.buffer: Dict[str, List[tuple]] = {}
+        self.pending: List[dict] = []
+        self._flushing: Optional[tuple] = None
+
+    def _discard_uncommitted(self, meta: dict):
+        self._truncate(meta["doc_bytes"], meta["docs"])
+        committed = set(meta["segments"])
+        for file_name in os.listdir(self.path):
+            if file_name.startswith("seg_") and file_name.split(".")[0] not in committed:
+                os.unlink(os.path.join(self.path, file_name))
+
+    def _truncate(self, doc_bytes: int, docs: int):
+        for name, size in (("docs.jsonl", doc_bytes), ("docs.idx", docs * 16)):
+            with open(os.path.join(self.path, name), "ab") as f:
+                f.truncate(size)
+
+    def _map_docs(self):
+        if self._docs is not None:
+            self._docs.close()
+        self._docs = None
+        if self.doc_bytes:
+            with open(os.path.join(self.path, "docs.jsonl"), "rb") as f:
+                self._docs = mmap.mmap(f.fileno(), self.doc_bytes, access=mmap.ACCESS_READ)
+
+    @property
+    def committed_docs(self) -> int:
+        return len(self._idx) // 2
+
+    @property
+    def doc_count(self) -> int:
+        flushing = len(self._flushing[1]) if self._flushing else 0
+        return self.committed_docs + flushing + len(self.pending)
+
+    def add(self, doc: dict):
+        tokens = tokenize(doc["content"])
+        doc_no = self.doc_count
+        for term, tf in Counter(tokens).items():
+            self.buffer.setdefault(term, []).append((doc_no, tf))
+        self.pending.append(dict(doc, length=len(tokens)))
+
+    def take_flush(self) -> Optional[tuple]:
+        if not self.pending or self._flushing:
+            return None
+        self._flushing = (self.buffer, self.pending)
+        self.buffer, self.pending = {}, []
+        return self._flushing
+
+    def write_flush(self, batch: tuple):
+        """Runs in a worker thread: append the docs, write a segment, then commit meta."""
+        postings, docs = batch
+        # 上次失败的写入可能留下半截数据, 追加前先截回已提交的长度
+        self._truncate(self.doc_bytes, self.committed_docs)
+        offsets = array("Q")
+        doc_bytes = self.doc_bytes
+        with open(os.path.join(self.path, "docs.jsonl"), "ab") as f:
+            for doc in docs:
+                line = json.dumps(doc, ensure_ascii=False).encode() + b"\n"
+                offsets.append(doc_bytes)
+                offsets.append(doc["length"])
+                f.write(line)
+                doc_bytes += len(line)
+        with open(os.path.join(self.path, "docs.idx"), "ab") as f:
+            offsets.tofile(f)
+        name = self._next_segment_name()
+        Segment.write(self.path, name, postings)
+        self._write_meta(self.committed_docs + len(docs), doc_bytes, [segment.name for segment in self.segments] + [name])
+        return Segment(self.path, name), offsets, doc_bytes
+
+    def _next_segment_name(self) -> str:
+        # 合并后段号不再连续, 新段号取已有的最大值加一
+        last = max((int(segment.name[4:]) for segment in self.segments), default=-1)
+        return f"seg_{last + 1:06d}"
+
+    def _write_meta(self, docs: int, doc_bytes: int, segments: List[str]):
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"docs": docs, "doc_bytes": doc_bytes, "segments": segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def finish_flush(self, result: tuple):
+        segment, offsets, doc_bytes = result
+        _, docs = self._flushing
+        self._idx.extend(offsets)
+        self.total_length += sum(doc["length"] for doc in docs)
+        self.doc_bytes = doc_bytes
+        self.segments.append(segment)
+        self._map_docs()
+        self._flushing = None
+
+    def write_merge(self) -> tuple:
+        """Runs in a worker thread: merge all committed segments into one and commit meta."""
+        merged = list(self.segments)
+        terms = set().union(*(segment.terms for segment in merged))
+        # 段按文档编号递增排列, 按段顺序拼接即可保持每个词的倒排表有序
+        postings = {term: chain.from_iterable([segment.postings(term) for segment in merged]) for term in terms}
+        name = self._next_segment_name()
+        Segment.write(self.path, name, postings)
+        self._write_meta(self.committed_docs, self.doc_bytes, [name])
+        return Segment(self.path, name), merged
+
+    def finish_merge(self, result: tuple):
+        segment, merged = result
+        self.segments = [segment] + self.segments[len(merged):]
+        for old in merged:
+            old.close()
+            # 删除失败的旧段文件在下次打开时按未提交的段清理
+            for suffix in (".post", ".terms"):
+                with suppress(OSError):
+                    os.unlink(os.path.join(self.path, old.name + suffix))
+
+    def abort_flush(self):
+        # 写入失败时把数据放回缓冲区, 下次再试; 写了一半的数据在重试或下次打开时截掉
+        postings, docs = self._flushing
+        for term, entries in self.buffer.items():
+            postings.setdefault(term, []).extend(entries)
+        self.buffer = postings
+        self.pending = docs + self.pending
+        self._flushing = None
+
+    def _postings(self, term: str):
+        for segment in self.segments:
+            yield from segment.postings(term)
+        if self._flushing:
+            yield from self._flushing[0].get(term, ())
+        yield from self.buffer.get(term, ())
+
+    def _doc(self, doc_no: int) -> dict:
+        if doc_no < self.committed_docs:
+            start = self._idx[doc_no * 2]
+            end = self._idx[doc_no * 2 + 2] if doc_no + 1 < self.committed_docs else self.doc_bytes
+            return json.loads(self._docs[start:end])
+        doc_no -= self.committed_docs
+        if self._flushing:
+            if doc_no < len(self._flushing[1]):
+                return self._flushing[1][doc_no]
+            doc_no -= len(self._flushing[1])
+        return self.pending[doc_no]
+
+    def _length(self, doc_no: int) -> int:
+        if doc_no < self.committed_docs:
+            return self._idx[doc_no * 2 + 1]
+        return self._doc(doc_no)["length"]
+
+    def search(self, query: str, offset: int = 0, limit: int = 20) -> dict:
+        terms = set(tokenize(query))
+        total_docs = self.doc_count
+        if not terms or not total_docs:
+            return {"total": 0, "results": []}
+        pending_length = sum(doc["length"] for doc in self.pending)
+        if self._flushing:
+            pending_length += sum(doc["length"] for doc in self._flushing[1])
+        avg_length = (self.total_length + pending_length) / total_docs or 1
+        scores: Dict[int, float] = {}
+        for term in terms:
+            postings = list(self._postings(term))
+            if not postings:
+                continue
+            idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_no, tf in postings:
+                norm = K1 * (1 - B + B * self._length(doc_no) / avg_length)
+                scores[doc_no] = scores.get(doc_no, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        # 分数相同时新消息在前
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        results = []
+        for doc_no, score in ranked[offset:offset + limit]:
+            doc = {key: value for key, value in self._doc(doc_no).items() if key != "length"}
+            doc["score"] = round(score, 4)
+            results.append(doc)
+        return {"total": len(ranked), "results": results}
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        if self._docs is not None:
+            self._docs.close()
+
+
+class SearchIndex:
+    """Room-scoped full-text search over chat history, fed by ChatRoomManager.send_message.
+
+    Tokenizing, scoring and file IO run in worker threads; `_lock` guards the open
+    rooms and their in-memory state, segment files are written outside it.
+    The index directory belongs to one process, guarded by a flock on `<root>/.lock`.
+    """
+
+    def __init__(self, root: str = SEARCH_INDEX_DIR, enabled: bool = SEARCH_ENABLED):
+        self.root = root
+        self.enabled = enabled
+        self.rooms: "OrderedDict[str, RoomIndex]" = OrderedDict()
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self._lock_fd: Optional[int] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def open(self) -> bool:
+        """Take the index directory for this process; False if another process holds it."""
+        if self._lock_fd is not None:
+            return True
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(os.path.join(self.root, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def start(self):
+        if not self.enabled:
+            return
+        # 多个 worker 共用一个索引目录会互相截断文件, 只有拿到锁的进程提供搜索
+        if not self.open():
+            logging.error(f"search index {self.root} is used by another process, search disabled in this worker")
+            self.enabled = False
+            return
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                for room_id in [room_id for room_id, index in self.rooms.items() if index.pending]:
+                    await self.flush(room_id)
+                await asyncio.to_thread(self._evict_idle)
+            except Exception:
+                logging.exception("periodic search index flush failed")
+
+    def _evict_idle(self):
+        with self._lock:
+            self._evict()
+
+    def room(self, room_id: str) -> RoomIndex:
+        with self._lock:
+            return self._room(room_id)
+
+    def _room(self, room_id: str) -> RoomIndex:
+        index = self.rooms.get(room_id)
+        if index is not None:
+            self.rooms.move_to_end(room_id)
+            return index
+        if not self.open():
+            raise OSError(f"search index {self.root} is used by another process")
+        if not re.fullmatch(r"[0-9A-Za-z_-]+", room_id):
+            raise ValueError(f"invalid room id: {room_id}")
+        index = self.rooms[room_id] = RoomIndex(os.path.join(self.root, room_id))
+        self._evict(keep=room_id)
+        return index
+
+    def _evict(self, keep: Optional[str] = None):
+        # 还有未写盘数据的房间不关闭, 由定时刷盘写完后再关闭
+        for room_id in list(self.rooms):
+            if len(self.rooms) <= OPEN_ROOMS:
+                break
+            index = self.rooms[room_id]
+            if room_id == keep or index.pending or index._flushing or index.buffer or room_id in self._flush_tasks:
+                continue
+            self.rooms.pop(room_id).close()
+
+    async def add(self, message: dict):
+        if not self.enabled:
+            return
+        room_id = message["room_id"]
+        doc = {
+            "id": str(message["_id"]),
+            "sender_username": message["sender_username"],
+            "content": message["content"],
+            "created_at": message["created_at"].isoformat(),
+        }
+        pending = await asyncio.to_thread(self._add, room_id, doc)
+        if pending >= FLUSH_DOCS and room_id not in self._flush_tasks:
+            self._schedule_flush(room_id)
+
+    def _add(self, room_id: str, doc: dict) -> int:
+        with self._lock:
+            index = self._room(room_id)
+            index.add(doc)
+            return len(index.pending)
+
+    def _schedule_flush(self, room_id: str) -> asyncio.Task:
+        # 同一个房间同时只有一个刷盘任务, 写段和合并都在里面顺序进行
+        task = self._flush_tasks.get(room_id)
+        if task is None or task.done():
+            task = self._flush_tasks[room_id] = asyncio.create_task(asyncio.to_thread(self._flush, room_id))
+            task.add_done_callback(lambda done: self._flushed(room_id, done))
+        return task
+
+    def _flushed(self, room_id: str, task: asyncio.Task):
+        if self._flush_tasks.get(room_id) is task:
+            del self._flush_tasks[room_id]
+
+    async def flush(self, room_id: str):
+        task = self._flush_tasks.get(room_id)
+        if task is not None:
+            await task
+        await self._schedule_flush(room_id)
+
+    def _flush(self, room_id: str):
+        with self._lock:
+            index = self.rooms.get(room_id)
+            batch = index.take_flush() if index else None
+        if batch is None:
+            return
+        try:
+            result = index.write_flush(batch)
+        except OSError:
+            logging.exception(f"failed to flush search index of room {room_id}")
+            with self._lock:
+                index.abort_flush()
+            return
+        with self._lock:
+            index.finish_flush(result)
+        if len(index.segments) <= MAX_SEGMENTS:
+            return
+        try:
+            result = index.write_merge()
+        except OSError:
+            logging.exception(f"failed to merge search index segments of room {room_id}")
+            return
+        with self._lock:
+            index.finish_merge(result)
+        logging.info(f"merged {len(result[1])} search index segments of room {room_id}")
+
+    async def search(self, room_id: str, query: str, offset: int = 0, limit: int = 20) -> dict:
+        limit = max(1, min(limit, PAGE_MAX))
+        return await asyncio.to_thread(self._search, room_id, query, max(0, offset), limit)
+
+    def _search(self, room_id: str, query: str, offset: int, limit: int) -> dict:
+        with self._lock:
+            return self._room(room_id).search(query, offset, limit)
+
+    def drop(self, room_id: str):
+        with self._lock:
+            index = self.rooms.pop(room_id, None)
+            if index is not None:
+                index.close()
+        shutil.rmtree(os.path.join(self.root, room_id), ignore_errors=True)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        for task in list(self._flush_tasks.values()):
+            await task
+        for room_id in list(self.rooms):
+            await self.flush(room_id)
+            with self._lock:
+                self.rooms.pop(room_id).close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+search_index = SearchIndex()
@@ -0,0 +1,48 @@
+import argparse
+import asyncio
+import logging
+
+from backend.db.chat_room import MESSAGE_PAGE_MAX, chat_rooms_collection, get_room_messages, message_cursor
+from backend.search.index import FLUSH_DOCS, search_index
+
+# 比任何消息都早的游标, 从房间的第一条消息开始按时间顺序读取
+FIRST_CURSOR = "0-" + "0" * 24
+
+
+async def rebuild_room(room_id: str) -> int:
+    """Drop a room's index and backfill it from the message store, oldest first."""
+    search_index.drop(room_id)
+    index = search_index.room(room_id)
+    cursor = FIRST_CURSOR
+    count = 0
+    while True:
+        page = await get_room_messages(room_id, MESSAGE_PAGE_MAX, after=cursor)
+        if not page:
+            break
+        for message in page:
+            await search_index.add(message)
+        count += len(page)
+        cursor = message_cursor(page[-1])
+        if len(index.pending) >= FLUSH_DOCS:
+            await search_index.flush(room_id)
+    await search_index.flush(room_id)
+    return count
+
+
+async def main(room_ids: list[str]):
+    if not search_index.open():
+        raise SystemExit(f"search index {search_index.root} is in use, stop the backend first")
+    if not room_ids:
+        room_ids = [str(room["_id"]) async for room in chat_rooms_collection.find({}, {"_id": 1})]
+    for room_id in room_ids:
+        count = await rebuild_room(room_id)
+        logging.info(f"indexed {count} messages of room {room_id}")
+    await search_index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rebuild the local search index from MongoDB (run with the backend stopped)")
+    parser.add_argument("--room", action="append", default=[], help="room id to rebuild, all rooms by default")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.room))
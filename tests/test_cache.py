@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+
+from backend.cache import AsyncCache
+
+
+class AsyncCacheLoadTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancelled_caller_does_not_cancel_waiters(self):
+        cache = AsyncCache("test", maxsize=10, ttl=60)
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "value"
+
+        first = asyncio.create_task(cache.get_or_load("key", loader))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_load("key", loader))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        self.assertEqual(await second, "value")
+        self.assertTrue(first.cancelled())
+        self.assertEqual(calls, 1)
+        self.assertEqual(cache.get("key"), (True, "value"))
+
+    async def test_errors_are_shared_and_not_cached(self):
+        cache = AsyncCache("test", maxsize=10, ttl=60)
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise LookupError("boom")
+
+        results = await asyncio.gather(
+            cache.get_or_load("key", loader), cache.get_or_load("key", loader), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(result, LookupError) for result in results))
+        self.assertEqual(cache.get("key"), (False, None))
+        self.assertEqual(cache.coalesced, 1)
+
+    async def test_invalidate_during_load_skips_write_back(self):
+        cache = AsyncCache("test", maxsize=10, ttl=60)
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            return "stale"
+
+        load = asyncio.create_task(cache.get_or_load("key", loader))
+        await asyncio.sleep(0)
+        cache.invalidate("key")
+        self.assertEqual(await load, "stale")
+        self.assertEqual(cache.get("key"), (False, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from backend.db.chat_room import BucketStore, DocumentStore, HistoryPage, message_cursor
+from backend.db.memory import MemoryClient
+
+ROOM_ID = "room"
+TOTAL = 53
+PAGE = 5
+FIRST_CURSOR = "0-" + "0" * 24
+
+
+def make_messages():
+    start = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    # 同一毫秒里有多条消息, 微秒部分写入后会被截掉
+    return [
+        {
+            "_id": ObjectId(),
+            "room_id": ROOM_ID,
+            "content": f"m{i}",
+            "created_at": start + timedelta(microseconds=i * 250),
+        }
+        for i in range(TOTAL)
+    ]
+
+
+class MemoryPagingTest(unittest.IsolatedAsyncioTestCase):
+    async def collect(self, store, backward: bool):
+        seen = []
+        cursor = None if backward else FIRST_CURSOR
+        for _ in range(TOTAL):
+            page = HistoryPage(PAGE, cursor if backward else None, None if backward else cursor, None)
+            batch = [message async for message in store.iter_page(ROOM_ID, page)]
+            if not batch:
+                break
+            seen.extend(message["content"] for message in batch)
+            cursor = message_cursor(batch[-1])
+        return seen
+
+    async def check_store(self, store):
+        messages = make_messages()
+        await store.insert_many(messages)
+        expected = [message["content"] for message in messages]
+        self.assertEqual(await self.collect(store, backward=True), expected[::-1])
+        self.assertEqual(await self.collect(store, backward=False), expected)
+
+    async def test_document_store(self):
+        await self.check_store(DocumentStore(MemoryClient().db.messages))
+
+    async def test_bucket_store(self):
+        await self.check_store(BucketStore(MemoryClient().db.message_buckets))
+
+    async def test_latest_message_per_room(self):
+        store = DocumentStore(MemoryClient().db.messages)
+        messages = make_messages()
+        await store.insert_many(messages)
+        latest = await store.latest([ROOM_ID, "empty"])
+        self.assertEqual(list(latest), [ROOM_ID])
+        self.assertEqual(latest[ROOM_ID]["content"], messages[-1]["content"])
+
+    async def test_datetimes_are_cut_to_milliseconds(self):
+        collection = MemoryClient().db.messages
+        await collection.insert_one({"created_at": datetime(2024, 1, 1, 0, 0, 0, 123456)})
+        await collection.update_one({}, {"$max": {"end": datetime(2024, 1, 1, 0, 0, 1, 999999)}})
+        doc = await collection.find_one({})
+        self.assertEqual(doc["created_at"].microsecond, 123000)
+        self.assertEqual(doc["end"].microsecond, 999000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import unittest
+
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+from backend.db.chat_room import MessageWriter
+
+
+class FakeStore:
+    """Accepts rows unless `down` is set or a row's content is in `bad`."""
+
+    def __init__(self, bad=(), error=OverflowError):
+        self.bad = set(bad)
+        self.error = error
+        self.down = False
+        self.rows = []
+
+    async def insert_many(self, batch):
+        if self.down:
+            raise AutoReconnect("down")
+        # 模拟客户端 BSON 编码失败: 整批在发出前就被拒绝
+        if any(row["content"] in self.bad for row in batch):
+            raise self.error("MongoDB can only handle up to 8-byte ints")
+        self.rows.extend(batch)
+        return [], []
+
+
+def message(content: str) -> dict:
+    return {"_id": ObjectId(), "room_id": "room", "content": content}
+
+
+class MessageWriterFailureTest(unittest.IsolatedAsyncioTestCase):
+    async def test_bad_row_is_dropped_and_writer_keeps_running(self):
+        store = FakeStore(bad={"bad"})
+        writer = MessageWriter(store, batch_size=10, interval=0.01)
+        for content in ("a", "bad", "b", "c", "d"):
+            writer.submit(message(content))
+        await asyncio.sleep(0.1)
+        self.assertEqual([row["content"] for row in store.rows], ["a", "b", "c", "d"])
+        self.assertEqual(writer.pending, [])
+        self.assertEqual(writer.rejected, 1)
+        self.assertFalse(writer._task.done())
+
+        writer.submit(message("e"))
+        await writer.close()
+        self.assertEqual(store.rows[-1]["content"], "e")
+
+    async def test_transient_errors_are_retried(self):
+        store = FakeStore()
+        store.down = True
+        writer = MessageWriter(store, batch_size=10, interval=0.01)
+        for i in range(3):
+            writer.submit(message(str(i)))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(writer.pending), 3)
+        self.assertGreater(writer.backoff, writer.interval)
+        store.down = False
+        await writer.close()
+        self.assertEqual(len(store.rows), 3)
+        self.assertEqual(writer.rejected, 0)
+
+    async def test_dead_task_is_restarted(self):
+        store = FakeStore()
+        writer = MessageWriter(store, batch_size=10, interval=0.01)
+        writer._task = asyncio.create_task(asyncio.sleep(0))
+        await writer._task
+        writer.submit(message("a"))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(store.rows), 1)
+        await writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from bson import ObjectId
+
+from backend.chat_room import room_chat
+from backend.chat_room.broker import InMemoryBroker
+from backend.chat_room.room_chat import ChatRoomManager, Frame, message_event
+
+ROOM_ID = "room"
+
+
+def make_messages(count: int):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "room_id": ROOM_ID,
+            "content": f"m{i}",
+            "sender_id": "u",
+            "sender_username": "user",
+            "created_at": start + timedelta(seconds=i),
+            "mentions": [],
+        }
+        for i in range(count)
+    ]
+
+
+class ReplaySeedTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.messages = make_messages(5)
+        self.queries = 0
+
+        async def get_room_messages(room_id, limit=50):
+            self.queries += 1
+            await asyncio.sleep(0.01)
+            # 和消息库一样按新到旧返回
+            return list(reversed(self.messages))[:limit]
+
+        patcher = mock.patch.object(room_chat, "get_room_messages", get_room_messages)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = ChatRoomManager(InMemoryBroker())
+
+    def contents(self, queue):
+        return [json.loads(frame.payload)["data"].get("content") for frame in queue.drain()]
+
+    async def test_empty_buffer_is_seeded_once(self):
+        last_seen = str(self.messages[2]["_id"])
+        queues = await asyncio.gather(*[self.manager.enter_room(f"u{i}", ROOM_ID, last_seen) for i in range(3)])
+        self.assertEqual(self.queries, 1)
+        for queue in queues:
+            self.assertEqual(self.contents(queue), ["m3", "m4"])
+
+        queue = await self.manager.enter_room("u", ROOM_ID, str(self.messages[4]["_id"]))
+        self.assertEqual(self.queries, 1)
+        self.assertEqual(queue.drain(), [])
+
+    async def test_live_events_during_seed_are_kept(self):
+        live = make_messages(1)[0]
+        live["content"] = "live"
+        entering = asyncio.create_task(self.manager.enter_room("u", ROOM_ID, str(self.messages[3]["_id"])))
+        await asyncio.sleep(0)
+        self.manager.fanout(Frame.encode(message_event(live), str(live["_id"])), ROOM_ID)
+        queue = await entering
+        self.assertEqual(self.contents(queue), ["m4", "live"])
+
+    async def test_unknown_event_gets_resync(self):
+        queue = await self.manager.enter_room("u", ROOM_ID, str(ObjectId()))
+        frames = queue.drain()
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(json.loads(frames[0].payload)["type"], "resync")
+
+
+if __name__ == "__main__":
+    unittest.main()